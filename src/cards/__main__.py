@@ -1,3 +1,9 @@
-from cards.cli import app
+import sys
 
-app()
+from cards.local import main
+
+# NOTE move and rename run without the full cli, which takes long to import
+if not main(sys.argv[1:]):
+    from cards.cli import app
+
+    app()
@@ -5,17 +5,132 @@ https://mochi.cards/docs/api/
 
 from __future__ import annotations
 
+import time
 from collections.abc import Iterator, Sequence
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 
 import requests
 from pydantic import BaseModel, ConfigDict, Field
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+from cards.scheduler import Scheduler
+from cards.trace import Request as TracedRequest, Tracer, endpoint_of
 
-def url_at(at: str) -> str:
-    return f"https://app.mochi.cards/api/{at}"
+default_base_url = "https://app.mochi.cards/api/"
+
+# NOTE responses worth retrying, the server might do better a bit later
+transient_status_codes = {429, 500, 502, 503, 504}
+
+
+@dataclass
+class MochiClient:
+    """
+    all requests go through here, with pooled connections, paced by the scheduler
+    transient errors are retried with exponential backoff, honoring Retry-After
+    """
+
+    session: requests.Session
+    scheduler: Scheduler = field(default_factory=Scheduler)
+    tracer: Tracer = field(default_factory=Tracer)
+    base_url: str = default_base_url
+    retries: int = 6
+    backoff: float = 0.5  # seconds, doubles with every retry
+    max_backoff: float = 60
+    timeout: float = 60
+
+    @classmethod
+    def from_token(cls, token: str, pool_size: int = 10, **kwargs):
+        session = requests.Session()
+        session.auth = auth_from_token(token)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        scheduler = Scheduler(concurrency=pool_size, max_concurrency=pool_size)
+        return cls(session, scheduler, **kwargs)
+
+    def url_at(self, at: str) -> str:
+        return f"{self.base_url}{at}"
+
+    def request(
+        self, method: str, at: str, idempotent: bool = True, **kwargs
+    ) -> requests.Response:
+        """
+        non-idempotent requests are only retried when we know the server did nothing
+        that is on 429 or when we could not even connect
+        """
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            try:
+                response = self.timed_request(method, at, **kwargs)
+            except requests.ConnectTimeout:
+                if last:
+                    raise
+                time.sleep(self.delay(attempt))
+                continue
+            except (requests.ConnectionError, requests.Timeout):
+                if last or not idempotent:
+                    raise
+                time.sleep(self.delay(attempt))
+                continue
+
+            retry = response.status_code == 429 or (
+                idempotent and response.status_code in transient_status_codes
+            )
+            if retry and not last:
+                time.sleep(self.delay(attempt, response.headers.get("Retry-After")))
+                continue
+
+            if response.status_code != 200:
+                raise requests.HTTPError(
+                    f"{response.status_code} on {method} {at}: {response.text}",
+                    response=response,
+                )
+            return response
+
+        assert False
+
+    def timed_request(self, method: str, at: str, **kwargs) -> requests.Response:
+        with self.scheduler.slot():
+            start = time.perf_counter()
+            try:
+                response = self.session.request(
+                    method, self.url_at(at), timeout=self.timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                latency = time.perf_counter() - start
+                self.scheduler.observe(None, latency)
+                self.tracer.request(
+                    TracedRequest(method, endpoint_of(at), None, 0, 0, latency), start
+                )
+                raise
+        latency = time.perf_counter() - start
+        self.scheduler.observe(response.status_code, latency)
+        body = response.request.body
+        self.tracer.request(
+            TracedRequest(
+                method,
+                endpoint_of(at),
+                response.status_code,
+                0 if body is None else len(body),
+                len(response.content),
+                latency,
+            ),
+            start,
+        )
+        return response
+
+    def delay(self, attempt: int, retry_after: None | str = None) -> float:
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                at = parsedate_to_datetime(retry_after).timestamp()
+                return min(max(0, at - time.time()), self.max_backoff)
+        return min(self.backoff * 2**attempt, self.max_backoff)
 
 
 def model_config():
@@ -57,100 +172,123 @@ class Card(BaseModel):
     template_id: None | str = None
 
 
-def iterate_paged_docs(auth: HTTPBasicAuth, url: str, params: dict) -> Iterator[dict]:
-    limit = 100
-    page_params = {"limit": limit}
-    while True:
-        response = requests.get(url, params={**params, **page_params}, auth=auth)
-        assert response.status_code == 200, response.text
-        response_json = response.json()
-        bookmark = response_json["bookmark"]
-        docs = response_json["docs"]
-        yield from docs
-        # TODO len(docs) < limit would be best
-        # but the api doesnt complain if you use a too high limit
-        # so len(docs) == 0 is the only robust way I can see, but uses an extra request
-        if len(docs) == 0:
-            break
-        page_params["bookmark"] = bookmark
-
-
-def raw_list_cards(auth: HTTPBasicAuth, deck_id: None | str = None) -> Iterator[dict]:
-    url = url_at("cards")
+max_page_size = 100
+
+
+def iterate_paged_docs(
+    client: MochiClient, at: str, params: dict, page_size: int = max_page_size
+) -> Iterator[dict]:
+    """the next page is already requested while the current page is consumed"""
+    assert 1 <= page_size <= max_page_size, page_size
+
+    def fetch(bookmark: None | str) -> dict:
+        page_params: dict = {"limit": page_size}
+        if bookmark is not None:
+            page_params["bookmark"] = bookmark
+        return client.request("GET", at, params={**params, **page_params}).json()
+
+    with ThreadPoolExecutor(1) as pool:
+        page = pool.submit(fetch, None)
+        bookmark = None
+        while True:
+            response_json = page.result()
+            docs = response_json["docs"]
+            # NOTE a short page does not mean there are no more pages
+            # the api does not complain about a too high limit, it silently caps it
+            # so only an empty page or no new bookmark is a robust end
+            more = (
+                len(docs) > 0
+                and response_json.get("bookmark") is not None
+                and response_json["bookmark"] != bookmark
+            )
+            if more:
+                bookmark = response_json["bookmark"]
+                page = pool.submit(fetch, bookmark)
+            yield from docs
+            if not more:
+                break
+
+
+def raw_list_cards(
+    client: MochiClient, deck_id: None | str = None, page_size: int = max_page_size
+) -> Iterator[dict]:
     params = {}
     if deck_id is not None:
         params["deck-id"] = deck_id
     # TODO now deal with tqdm higher up, where we might have some len() estimate
-    return iterate_paged_docs(auth, url, params)
+    return iterate_paged_docs(client, "cards", params, page_size)
 
 
-def list_cards(auth: HTTPBasicAuth, deck_id: None | str = None) -> Iterator[Card]:
-    for doc in raw_list_cards(auth, deck_id):
+def list_cards(
+    client: MochiClient, deck_id: None | str = None, page_size: int = max_page_size
+) -> Iterator[Card]:
+    for doc in raw_list_cards(client, deck_id, page_size):
         yield Card(**doc)
 
 
-def raw_create_card(auth: HTTPBasicAuth, deck_id: str, content: str) -> dict:
-    url = url_at("cards")
+def raw_create_card(client: MochiClient, deck_id: str, content: str) -> dict:
     body = {
         "deck-id": deck_id,
         "content": content,
     }
-    response = requests.post(url, json=body, auth=auth)
-    assert response.status_code == 200, response.text
+    # NOTE not idempotent, a blind retry could create the card twice
+    response = client.request("POST", "cards", idempotent=False, json=body)
     return response.json()
 
 
 def create_card(
-    auth: HTTPBasicAuth, deck_id: str, content: str, attachments: list[Attachment]
+    client: MochiClient, deck_id: str, content: str, attachments: list[Attachment]
 ) -> Card:
-    card = Card(**raw_create_card(auth, deck_id, content))
+    card = Card(**raw_create_card(client, deck_id, content))
     for attachment in attachments:
-        raw_update_attachment(auth, card.id, attachment)
+        raw_update_attachment(client, card.id, attachment)
     return card
 
 
-def raw_retrieve_card(auth: HTTPBasicAuth, card_id: str) -> dict:
-    url = url_at(f"cards/{card_id}")
-    response = requests.get(url, auth=auth)
-    assert response.status_code == 200, response.text
+def raw_retrieve_card(client: MochiClient, card_id: str) -> dict:
+    response = client.request("GET", f"cards/{card_id}")
     return response.json()
 
 
-def retrieve_card(auth: HTTPBasicAuth, card_id: str) -> Card:
-    return Card(**raw_retrieve_card(auth, card_id))
+def retrieve_card(client: MochiClient, card_id: str) -> Card:
+    return Card(**raw_retrieve_card(client, card_id))
+
 
+def raw_retrieve_attachment(client: MochiClient, id: str, file_name: str) -> bytes:
+    response = client.request("GET", f"cards/{id}/attachments/{file_name}")
+    return response.content
 
-def raw_update_attachment(auth: HTTPBasicAuth, id: str, attachment: Attachment):
-    url = url_at(f"cards/{id}/attachments/{attachment.file_name}")
-    response = requests.post(url, files={"file": attachment.binary_data}, auth=auth)
-    assert response.status_code == 200, response.text
+
+def raw_update_attachment(client: MochiClient, id: str, attachment: Attachment):
+    client.request(
+        "POST",
+        f"cards/{id}/attachments/{attachment.file_name}",
+        files={"file": attachment.binary_data},
+    )
 
 
-def raw_update_card(auth: HTTPBasicAuth, card: dict) -> dict:
-    url = url_at(f"cards/{card['id']}")
+def raw_update_card(client: MochiClient, card: dict) -> dict:
+    at = f"cards/{card['id']}"
     # TODO I dont like this, how to control what's passed what not?
     # pydantic Model stuff is good for validation, but we probably still need to control what goes thru?
     # because in listing, a card has an id, when updating, the card id comes thru the url ...
     # so we cannot really make the Card Model the only thing, maybe to model_dump(include=...) explicitely?
     card.pop("id")
-    response = requests.post(url, json=card, auth=auth)
-    assert response.status_code == 200, response.text
+    response = client.request("POST", at, json=card)
     return response.json()
 
 
 def update_card(
-    auth: HTTPBasicAuth, card: Card, attachments: Sequence[Attachment]
+    client: MochiClient, card: Card, attachments: Sequence[Attachment]
 ) -> Card:
     for attachment in attachments:
         # NOTE depending on changes, we might end up with unreferenced images for a card on the server
-        raw_update_attachment(auth, card.id, attachment)
-    return Card(**raw_update_card(auth, body_from_model(card)))
+        raw_update_attachment(client, card.id, attachment)
+    return Card(**raw_update_card(client, body_from_model(card)))
 
 
-def delete_card(auth: HTTPBasicAuth, card_id: str):
-    url = url_at(f"cards/{card_id}")
-    response = requests.delete(url, auth=auth)
-    assert response.status_code == 200, response.text
+def delete_card(client: MochiClient, card_id: str):
+    client.request("DELETE", f"cards/{card_id}")
 
 
 def auth_from_token(token: str) -> HTTPBasicAuth:
@@ -1,22 +1,251 @@
+"""
+backups are gzipped json lines, one card per line, written while pages arrive
+a full backup has all cards of a deck
+an incremental backup has only cards that changed since the backups before it,
+and a line with the removed key for each card that is gone
+attachments are stored by the hash of their data, so each is kept only once
+"""
+
+from __future__ import annotations
+
 import datetime
+import gzip
 import json
+import os
+import re
+import threading
+from collections.abc import Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from hashlib import sha256
 from pathlib import Path
 
 import click
+import requests
 from tqdm import tqdm
 
-from cards.api import auth_from_token, raw_list_cards
+from cards.api import MochiClient, raw_list_cards, raw_retrieve_attachment
+from cards.data import media_hashes
+
+removed_key = "cards-backup-removed"
+
+
+@dataclass
+class Backup:
+    path: Path
+    at: str
+    incremental: bool
+
+    def read(self) -> Iterator[dict]:
+        # NOTE older backups are a single indented json document
+        if self.path.suffix == ".json":
+            yield from json.loads(self.path.read_text())
+            return
+        with gzip.open(self.path, "rt") as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def name_pattern(deck_id: str) -> re.Pattern:
+    return re.compile(
+        rf"backup-mochi-deck-{re.escape(deck_id)}-from-(?P<at>[0-9T-]+?)"
+        r"(?P<incremental>-incremental)?\.(json|jsonl\.gz)"
+    )
+
+
+def list_backups(folder: Path, deck_id: str) -> list[Backup]:
+    """the latest full backup and the incremental ones after it, oldest first"""
+    pattern = name_pattern(deck_id)
+    backups = sorted(
+        (
+            Backup(path, match["at"], match["incremental"] is not None)
+            for path in folder.glob(f"backup-mochi-deck-{deck_id}-from-*")
+            if (match := pattern.fullmatch(path.name)) is not None
+        ),
+        key=lambda b: b.at,
+    )
+    fulls = [i for i, b in enumerate(backups) if not b.incremental]
+    if len(fulls) == 0:
+        return []
+    return backups[fulls[-1] :]
+
+
+def replay(backups: Iterable[Backup]) -> Iterator[tuple[str, None | dict]]:
+    """card id and card, or None when it was removed"""
+    for backup in backups:
+        for card in backup.read():
+            yield card["id"], None if card.get(removed_key) else card
+
+
+def restore(folder: Path, deck_id: str) -> dict[str, dict]:
+    """the state of the deck at the time of the last backup"""
+    cards: dict[str, dict] = dict()
+    for id, card in replay(list_backups(folder, deck_id)):
+        if card is None:
+            cards.pop(id, None)
+        else:
+            cards[id] = card
+    return cards
+
+
+def hash_card(card: dict) -> str:
+    return sha256(json.dumps(card, sort_keys=True).encode()).hexdigest()
+
+
+def write_backup(path: Path, cards: Iterable[dict]) -> int:
+    """streams to a temporary file first, so that a backup is never partial"""
+    partial = path.with_name(f"{path.name}.partial")
+    count = 0
+    with gzip.open(partial, "wt") as f:
+        for card in cards:
+            f.write(json.dumps(card) + "\n")
+            count += 1
+    partial.replace(path)
+    return count
 
 
-def backup_deck(token: str, deck_name: str, deck_id: str):
-    date = datetime.date.today()
-    path = Path(f"backup-mochi-deck-{deck_id}-from-{date.isoformat()}.json")
+# NOTE attachments as referenced in card content, like ![](@media/name)
+attachment_pattern = re.compile(r"@media/([^\s)\"]+)")
+
+
+@dataclass
+class Attachments:
+    """
+    a content-addressed store, data is at its sha256
+    and an index from card and file name to the hash, for references without one
+    """
+
+    folder: Path
+    index: dict[str, str] = field(default_factory=dict)
+    # NOTE keys of this run, the index is written with only those
+    used: set[str] = field(default_factory=set)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    @classmethod
+    def from_folder(cls, folder: Path):
+        at = folder / "attachments" / "index.json"
+        index = json.loads(at.read_text()) if at.exists() else {}
+        return cls(folder / "attachments", index)
+
+    def path_of(self, hash: str) -> Path:
+        return self.folder / hash[:2] / hash
+
+    def put(self, data: bytes) -> str:
+        hash = sha256(data).hexdigest()
+        path = self.path_of(hash)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            partial = path.with_name(f"{hash}.{threading.get_ident()}.partial")
+            partial.write_bytes(data)
+            partial.replace(path)
+        return hash
+
+    def known(self, key: str, claimed: None | str) -> bool:
+        """key identifies the reference, claimed is the hash in the content, if any"""
+        with self.lock:
+            for candidate in [claimed, self.index.get(key)]:
+                if candidate is not None and self.path_of(candidate).exists():
+                    self.index[key] = candidate
+                    self.used.add(key)
+                    return True
+            return False
+
+    def add(self, key: str, data: bytes):
+        hash = self.put(data)
+        with self.lock:
+            self.index[key] = hash
+            self.used.add(key)
+
+    def write_index(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        at = self.folder / "index.json"
+        with self.lock:
+            index = {k: h for k, h in self.index.items() if k in self.used}
+            data = json.dumps(index, indent=1, sort_keys=True)
+        at.with_name("index.json.new").write_text(data)
+        os.replace(at.with_name("index.json.new"), at)
+
+
+def download_attachments(
+    client: MochiClient,
+    attachments: Attachments,
+    downloads: ThreadPoolExecutor,
+    card: dict,
+) -> list[Future[bool]]:
+    hashes = media_hashes(card["content"])
+    futures = []
+    for name in set(attachment_pattern.findall(card["content"])):
+        # NOTE updated-at, so that a changed attachment under the same name is fetched
+        key = f"{card['id']}/{name}@{card.get('updated-at')}"
+        if attachments.known(key, hashes.get(name)):
+            continue
+
+        def download(id: str = card["id"], name: str = name, key: str = key) -> bool:
+            try:
+                attachments.add(key, raw_retrieve_attachment(client, id, name))
+                return True
+            # NOTE also connection errors and timeouts, one attachment should not
+            # stop the backup of the whole deck
+            except requests.RequestException as e:
+                print(f"could not download {name} of card {id}: {e}")
+                return False
+
+        futures.append(downloads.submit(download))
+    return futures
+
+
+def backup_deck(
+    client: MochiClient,
+    deck_name: str,
+    deck_id: str,
+    attachments: Attachments,
+    downloads: ThreadPoolExecutor,
+    incremental: bool = False,
+    folder: Path = Path("."),
+    position: int = 0,
+):
+    """attachments are downloaded on the downloads pool, as the cards arrive"""
+    previous: None | dict[str, str] = None
+    if incremental:
+        backups = list_backups(folder, deck_id)
+        if len(backups) == 0:
+            print(f"no full backup of deck {deck_name} yet, making one")
+        else:
+            # NOTE only hashes, so that we dont keep all cards in memory
+            previous = dict()
+            for id, card in replay(backups):
+                if card is None:
+                    previous.pop(id, None)
+                else:
+                    previous[id] = hash_card(card)
+
+    at = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
+    suffix = "-incremental" if previous is not None else ""
+    path = folder / f"backup-mochi-deck-{deck_id}-from-{at}{suffix}.jsonl.gz"
     if path.exists():
         click.confirm(f"Overwrite {path}?", abort=True)
 
-    auth = auth_from_token(token)
-    cards = list(
-        tqdm(raw_list_cards(auth, deck_id), desc=f"list cards of deck {deck_name}")
-    )
+    futures: list[Future[bool]] = []
 
-    path.write_text(json.dumps(cards, indent=4))
+    def changed() -> Iterator[dict]:
+        seen = set()
+        cards = raw_list_cards(client, deck_id)
+        for card in tqdm(
+            cards, desc=f"list cards of deck {deck_name}", position=position
+        ):
+            seen.add(card["id"])
+            futures.extend(download_attachments(client, attachments, downloads, card))
+            if previous is None or previous.get(card["id"]) != hash_card(card):
+                yield card
+        if previous is not None:
+            for id in previous.keys() - seen:
+                yield {"id": id, removed_key: True}
+
+    with client.tracer.phase(f"backup deck {deck_name}"):
+        count = write_backup(path, changed())
+        downloaded = sum(future.result() for future in futures)
+    failed = len(futures) - downloaded
+    print(
+        f"wrote {count} cards to {path}, downloaded {downloaded} attachments"
+        + (f", {failed} failed" if failed > 0 else "")
+    )
@@ -0,0 +1,343 @@
+"""
+benchmarks with synthetic collections
+sync runs against the local fake of the mochi api, so nothing real is touched
+"""
+
+from __future__ import annotations
+
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from collections.abc import Callable
+from contextlib import redirect_stdout
+from copy import deepcopy
+from dataclasses import dataclass
+from io import StringIO
+from pathlib import Path
+
+import PIL
+from PIL import Image, ImageDraw
+
+from cards.cache import Cache
+from cards.data import Images
+from cards.fake import FakeServer, Faults, Stats
+from cards.markdown import Markdown, pandoc_version
+from cards.scan import check, scan
+from cards.sync import sync
+
+
+def generate_image(path: Path, rng: random.Random):
+    width = rng.choice([200, 600, 1200, 2400])
+    height = rng.randint(width // 4, width)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for _ in range(rng.randint(3, 30)):
+        x, y = rng.randrange(width), rng.randrange(height)
+        r = rng.randint(5, width // 4)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        draw.ellipse((x - r, y - r, x + r, y + r), outline=color, width=3)
+    image.save(path)
+
+
+def generate_card(rng: random.Random, images: list[str]) -> str:
+    words = ["what", "is", "the", "derivative", "of", "a", "function", "why", "how"]
+
+    def text(n: int) -> str:
+        return " ".join(rng.choice(words) for _ in range(n))
+
+    question = [f"{text(rng.randint(3, 15))}?"]
+    if rng.random() < 0.3:
+        question.append(f"$f(x) = x^{rng.randint(2, 9)}$")
+    answer = [text(rng.randint(1, 60)) for _ in range(rng.randint(1, 4))]
+    if rng.random() < 0.3:
+        answer.append(f"![]({rng.choice(images)})")
+    if rng.random() < 0.3:
+        answer.append(f"prompt: {text(rng.randint(2, 8))}")
+    return "\n\n".join([*question, "---", *answer]) + "\n"
+
+
+def generate_collection(
+    base: Path, cards: int, decks: int = 4, images: int = 10, seed: int = 0
+) -> dict[str, str]:
+    """writes a synthetic collection to base, returns deck name -> deck id"""
+    rng = random.Random(seed)
+    deck_ids = {f"deck{d}": f"fake-deck-{d}" for d in range(decks)}
+    names = [f"image{i}.png" for i in range(images)]
+    for deck in deck_ids:
+        (base / deck).mkdir(parents=True, exist_ok=True)
+        for name in names:
+            generate_image(base / deck / name, rng)
+    for c in range(cards):
+        deck = f"deck{c % decks}"
+        (base / deck / f"card{c:06}.md").write_text(generate_card(rng, names))
+    return deck_ids
+
+
+@dataclass
+class SyncResult:
+    cards: int
+    run: str
+    seconds: float
+    requests: int
+    bytes_sent: int  # by us, to the fake
+    bytes_received: int  # by us, from the fake
+    throttled: int
+    errors: int
+
+
+def bench_sync(
+    base: Path,
+    cards: int,
+    faults: Faults,
+    jobs: int = 1,
+    concurrency: int = 4,
+) -> list[SyncResult]:
+    """initial sync, then no change, one changed card, and a full verification"""
+    base = base / f"sync-{cards}"
+    assert not base.exists(), f"{base} already exists"
+    decks = generate_collection(base, cards)
+    server = FakeServer.start(faults)
+    results: list[SyncResult] = []
+
+    def run(name: str, full: bool = False):
+        server.mochi.stats = Stats()
+        start = time.perf_counter()
+        with redirect_stdout(StringIO()):
+            sync(
+                "fake",
+                base,
+                decks,
+                jobs=jobs,
+                concurrency=concurrency,
+                full=full,
+                confirm=False,
+                base_url=server.base_url,
+            )
+        stats = server.mochi.stats
+        results.append(
+            SyncResult(
+                cards=cards,
+                run=name,
+                seconds=time.perf_counter() - start,
+                requests=stats.requests,
+                bytes_sent=stats.bytes_received,
+                bytes_received=stats.bytes_sent,
+                throttled=stats.throttled,
+                errors=stats.errors,
+            )
+        )
+
+    try:
+        run("initial")
+        run("unchanged")
+        card = next((base / "deck0").glob("*.md"))
+        card.write_text(card.read_text() + "\nedited\n")
+        run("one edit")
+        run("full", full=True)
+    finally:
+        server.stop()
+
+    return results
+
+
+def print_results(results: list[SyncResult]):
+    header = [
+        "cards",
+        "run",
+        "seconds",
+        "requests",
+        "kB sent",
+        "kB received",
+        "throttled",
+        "errors",
+    ]
+    rows = [
+        [
+            str(r.cards),
+            r.run,
+            f"{r.seconds:.2f}",
+            str(r.requests),
+            f"{r.bytes_sent / 1000:.0f}",
+            f"{r.bytes_received / 1000:.0f}",
+            str(r.throttled),
+            str(r.errors),
+        ]
+        for r in results
+    ]
+    widths = [max(len(c) for c in column) for column in zip(header, *rows)]
+    for row in [header, *rows]:
+        print("  ".join(c.rjust(w) for c, w in zip(row, widths)))
+
+
+def generate_sized_card(rng: random.Random, paragraphs: int, images: list[str]) -> str:
+    """a card with a reverse prompt, so that all stages have work to do"""
+    words = ["what", "is", "the", "derivative", "of", "a", "function", "why", "how"]
+
+    def text(n: int) -> str:
+        return " ".join(rng.choice(words) for _ in range(n))
+
+    question = [f"{text(10)}? $f(x) = x^2$"]
+    answer = [text(40) for _ in range(paragraphs)]
+    answer += [f"![]({image})" for image in images]
+    answer.append(f"prompt: {text(5)}")
+    return "\n\n".join([*question, "---", *answer]) + "\n"
+
+
+def measure(f: Callable[[], object], repeat: int) -> dict[str, float]:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        seconds.append(time.perf_counter() - start)
+    return {"min": min(seconds), "median": statistics.median(seconds)}
+
+
+def bench_micro(
+    base: Path,
+    paragraphs: list[int],
+    images: list[int],
+    repeat: int = 20,
+) -> dict:
+    """
+    seconds per call for each stage of making a card, for cards of different sizes
+    Images.collect is per card, for all its images, once without and once with cache
+    """
+    rng = random.Random(0)
+    base = base / "micro"
+    assert not base.exists(), f"{base} already exists"
+    base.mkdir(parents=True)
+    names = [f"image{i}.png" for i in range(max(images, default=0))]
+    for name in names:
+        generate_image(base / name, rng)
+
+    results = []
+    for p in paragraphs:
+        for i in images:
+            text = generate_sized_card(rng, p, names[:i])
+            markdown = Markdown.from_str(text)
+            prompted = markdown.maybe_prompted()
+
+            def collect(cache: Cache):
+                collector = Images.from_base(base, cache)
+                markdown.with_rewritten_images(collector.collect)
+
+            cache = Cache.from_base(base, f"images-{p}-{i}")
+            collect(cache)
+            stages: dict[str, Callable[[], object]] = {
+                "Markdown.from_str": lambda: Markdown.from_str(text),
+                "maybe_prompted": markdown.maybe_prompted,
+                "reversed": markdown.reversed,
+                "deepcopy": lambda: deepcopy(markdown.body),
+                "with_rewritten_images": lambda: markdown.with_rewritten_images(
+                    lambda path: (path, "0" * 64)
+                ),
+                "as_mochi_md_str": prompted.as_mochi_md_str,
+                "Images.collect": lambda: collect(Cache(base, enabled=False)),
+                "Images.collect cached": lambda: collect(cache),
+            }
+            for stage, f in stages.items():
+                results.append(
+                    {
+                        "stage": stage,
+                        "paragraphs": p,
+                        "images": i,
+                        "bytes": len(text),
+                        **measure(f, repeat),
+                    }
+                )
+
+    return {
+        "versions": {
+            "python": platform.python_version(),
+            "pandoc": pandoc_version(),
+            "pillow": PIL.__version__,
+        },
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+# NOTE texts where the scanner is easily wrong, they are checked along with the collection
+scan_corpus = [
+    "![a](b&amp;c.png)",
+    "$a![x](y.png)$",
+    "% title ![a](b.png)\n\nq",
+    "---\ntitle: ![a](b.png)\n---\n\nq",
+    "    ![a](b.png)",
+    ">     ![a](b.png)",
+    "-     ![a](b.png)",
+    "`![a](b.png)`",
+    "[![a](b.png)](c)",
+    '![a](b.png "title")',
+    "![a](c%20d.png)",
+    "![a](b.png) ![a](b.png)",
+    "::: ![a](b.png)",
+    "# h ![a\nb](k.png)",
+    "(@)     ![a]( i.png )",
+]
+
+
+def bench_scan(base: Path, decks: list[str]) -> dict:
+    """the scanner against pandoc, on a real collection and scan_corpus"""
+    paths = [path for deck in decks for path in (base / deck).rglob("*.md")]
+    texts = {path.relative_to(base): path.read_text() for path in paths}
+
+    start = time.perf_counter()
+    for text in texts.values():
+        scan(text)
+    scan_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    Markdown.from_strs(list(texts.values()))
+    pandoc_seconds = time.perf_counter() - start
+
+    corpus = {Path(f"scan_corpus[{i}]"): text for i, text in enumerate(scan_corpus)}
+    decided, wrong = check(texts | corpus)
+    return {
+        "cards": len(texts),
+        "decided": decided,
+        "wrong": [str(p) for p in wrong],
+        "scan seconds": scan_seconds,
+        "pandoc seconds": pandoc_seconds,
+    }
+
+
+def bench_startup(modules: list[str], repeat: int = 5) -> dict:
+    """
+    seconds for a fresh interpreter to import each module
+    and the slowest imports below it, as reported by python -X importtime
+    """
+    results = []
+    for module in modules:
+        seconds = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            seconds.append(time.perf_counter() - start)
+        # NOTE lines are "import time: self [us] | cumulative | imported package"
+        imports = [
+            (int(cumulative), name.strip())
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:") and "[us]" not in line
+            for _, cumulative, name in [line.removeprefix("import time:").split("|")]
+        ]
+        results.append(
+            {
+                "module": module,
+                "min": min(seconds),
+                "median": statistics.median(seconds),
+                "slowest imports": {
+                    name: cumulative / 1e6
+                    for cumulative, name in sorted(imports, reverse=True)[:10]
+                },
+            }
+        )
+    return {"python": platform.python_version(), "results": results}
@@ -0,0 +1,164 @@
+"""
+a static preview of all cards, both directions, as html files
+cards whose source and images did not change since the last build are skipped
+"""
+
+from __future__ import annotations
+
+import os
+from collections.abc import Sequence
+from functools import partial
+from html import escape
+from pathlib import Path
+from shutil import copyfile, copytree
+from urllib.parse import quote
+
+from tqdm import tqdm
+
+from cards.cache import key_from
+from cards.data import in_batches, map_in_processes
+from cards.fingerprints import (
+    Fingerprint,
+    hash_of,
+    read_fingerprints,
+    write_fingerprints,
+)
+from cards.markdown import Markdown, pandoc_version
+from cards.meta import Direction
+from cards.preview import get_katex_path, template_path
+
+
+def hash_images(folder: Path, images: Sequence[str]) -> None | dict[str, str]:
+    """None if an image is missing"""
+    try:
+        return {i: hash_of((folder / i).read_bytes()) for i in images}
+    except FileNotFoundError:
+        return None
+
+
+def is_unchanged(base: Path, path: Path, fingerprint: Fingerprint) -> bool:
+    """without parsing, a source with the same hash has the same image paths"""
+    if hash_of((base / path).read_bytes()) != fingerprint.source:
+        return False
+    return hash_images((base / path).parent, list(fingerprint.images)) == (
+        fingerprint.images
+    )
+
+
+fingerprints_name = Path("fingerprints.json")
+
+
+def html_name(path: Path, direction: Direction) -> Path:
+    return path.with_suffix(f".{direction.value}.html")
+
+
+def build_cards(
+    base: Path, out: Path, settings: str, paths: Sequence[Path]
+) -> list[tuple[Path, Fingerprint]]:
+    """writes html for both directions of each path, and copies its images"""
+    # NOTE the source is hashed as bytes, like is_unchanged does
+    sources = [(base / path).read_bytes() for path in paths]
+    texts = [source.decode() for source in sources]
+    results = []
+    for path, source, markdown in zip(paths, sources, Markdown.from_strs(texts)):
+        target = out / path
+        target.parent.mkdir(parents=True, exist_ok=True)
+
+        images = [str(p) for p in markdown.get_image_paths()]
+        for image in images:
+            source = (base / path.parent / image).resolve()
+            copy = Path(os.path.normpath(target.parent / image))
+            # NOTE images outside of the output folder are left alone
+            if source.exists() and copy.is_relative_to(out):
+                copy.parent.mkdir(parents=True, exist_ok=True)
+                copyfile(source, copy)
+
+        views = {Direction.forward: markdown.maybe_prompted()}
+        if markdown.has_reverse_prompt():
+            views[Direction.backward] = markdown.reversed().maybe_prompted()
+        katex = os.path.relpath(out / "katex", target.parent)
+        contents = dict()
+        for direction, view in views.items():
+            html = view.as_html(
+                [
+                    f"--katex={quote(katex)}/"
+                    if (out / "katex").exists()
+                    else "--katex",
+                    f"--metadata=pagetitle={path} ({direction.value})",
+                    "--standalone",
+                    f"--template={template_path}",
+                    f"--variable=preview_name:{path} ({direction.value})",
+                ]
+            )
+            html_name(target, direction).write_text(html)
+            contents[direction.value] = hash_of(html)
+        for direction in set(Direction) - set(views):
+            html_name(target, direction).unlink(missing_ok=True)
+
+        # NOTE with a missing image no hash matches, so the card is built again
+        # until the image is there, and then it is copied
+        hashes = hash_images(base / path.parent, images)
+        fingerprint = Fingerprint(
+            settings,
+            hash_of(source),
+            {i: "" for i in images} if hashes is None else hashes,
+            contents,
+        )
+        results.append((path, fingerprint))
+    return results
+
+
+def write_index(out: Path, fingerprints: dict[Path, Fingerprint]):
+    items = "\n".join(
+        f'<li><a href="{quote(html_name(path, Direction(direction)).as_posix())}">'
+        f"{escape(str(path))} ({direction})</a></li>"
+        for path, fingerprint in sorted(fingerprints.items())
+        for direction in fingerprint.contents
+    )
+    (out / "index.html").write_text(
+        "<!DOCTYPE html>\n"
+        '<html><head><meta charset="utf-8" /><title>cards</title></head><body>\n'
+        f"<ul>\n{items}\n</ul>\n"
+        "</body></html>\n"
+    )
+
+
+def build(base: Path, decks: Sequence[str], out: Path, jobs: int = 1):
+    out = out.absolute()
+    out.mkdir(parents=True, exist_ok=True)
+    katex_path = get_katex_path()
+    if katex_path.exists() and not (out / "katex").exists():
+        copytree(katex_path, out / "katex")
+
+    settings = key_from(
+        pandoc_version(), hash_of(template_path.read_bytes()), str(katex_path.exists())
+    )
+    paths = [
+        path.relative_to(base) for deck in decks for path in (base / deck).rglob("*.md")
+    ]
+    before = read_fingerprints(out, fingerprints_name)
+    fingerprints = {
+        path: before[path]
+        for path in paths
+        if path in before
+        and before[path].settings == settings
+        and is_unchanged(base, path, before[path])
+    }
+    for path in set(before) - set(paths):
+        for direction in Direction:
+            html_name(out / path, direction).unlink(missing_ok=True)
+
+    todo = [path for path in paths if path not in fingerprints]
+    batches = in_batches(todo, jobs)
+    built = map_in_processes(partial(build_cards, base, out, settings), batches, jobs)
+    with tqdm(
+        total=len(paths), initial=len(fingerprints), desc="build previews"
+    ) as progress:
+        for results in built:
+            fingerprints |= dict(results)
+            progress.update(len(results))
+            # NOTE so that an interrupted build keeps what it did
+            write_fingerprints(out, fingerprints, fingerprints_name)
+
+    write_index(out, fingerprints)
+    print(f"built {len(todo)} of {len(paths)} cards to {out / 'index.html'}")
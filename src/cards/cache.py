@@ -0,0 +1,85 @@
+"""
+persistent content-addressed cache on disk
+keys are sha256 digests of whatever fully determines a value
+values are pickled, one file per entry
+"""
+
+from __future__ import annotations
+
+import os
+import pickle
+import time
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+
+def key_from(*parts: bytes | str) -> str:
+    hash = sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # NOTE length prefix so that ("ab", "c") and ("a", "bc") are different keys
+        hash.update(len(part).to_bytes(8, "little"))
+        hash.update(part)
+    return hash.hexdigest()
+
+
+@dataclass
+class Cache:
+    folder: Path
+    enabled: bool = True
+    # NOTE pruning removes least recently used entries until the cache fits
+    max_bytes: int = 512 * 2**20
+    # NOTE pruning removes entries not used for that long, they are most likely stale
+    max_age: float = 30 * 24 * 60 * 60
+
+    @classmethod
+    def from_base(cls, base: Path, name: str, enabled: bool = True):
+        return cls(base / ".cache" / name, enabled)
+
+    def path_of(self, key: str) -> Path:
+        return self.folder / key[:2] / key
+
+    def get(self, key: str) -> None | object:
+        if not self.enabled:
+            return None
+        path = self.path_of(key)
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+        # NOTE mtime is the last use, this is what pruning looks at
+        # it also works when entries are used from other processes
+        os.utime(path)
+        return pickle.loads(data)
+
+    def put(self, key: str, value: object):
+        if not self.enabled:
+            return
+        path = self.path_of(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE write and rename, so that readers never see partial entries
+        with NamedTemporaryFile(dir=path.parent, delete=False) as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f.name, path)
+
+    def prune(self):
+        if not self.enabled or not self.folder.exists():
+            return
+        now = time.time()
+        entries: list[tuple[float, int, Path]] = []
+        for path in self.folder.glob("*/*"):
+            stat = path.stat()
+            if now - stat.st_mtime > self.max_age:
+                path.unlink()
+            else:
+                entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink()
+            total -= size
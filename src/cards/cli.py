@@ -1,5 +1,3 @@
-import subprocess
-import sys
 from pathlib import Path
 from typing import Annotated
 
@@ -19,37 +17,172 @@ def main(base: Path):
 
 
 @app.command()
-def sync():
+def sync(
+    cache: Annotated[
+        bool,
+        typer.Option(
+            "--cache/--no-cache", help="use the on-disk parse and image caches"
+        ),
+    ] = True,
+    jobs: Annotated[
+        int, typer.Option("--jobs", "-j", min=1, help="processes for local work")
+    ] = 1,
+    concurrency: Annotated[
+        int, typer.Option("--concurrency", "-c", min=1, help="concurrent api requests")
+    ] = 4,
+    full: Annotated[
+        bool,
+        typer.Option(
+            "--full", help="make and compare all cards, even if files did not change"
+        ),
+    ] = False,
+    fast: Annotated[
+        bool,
+        typer.Option(
+            "--fast",
+            help="trust the remote snapshot of the last sync instead of listing cards",
+        ),
+    ] = False,
+    yes: Annotated[
+        bool, typer.Option("--yes", "-y", help="do not ask before making changes")
+    ] = False,
+    trace: Annotated[
+        None | Path,
+        typer.Option(help="write a chrome trace of phases and requests to this file"),
+    ] = None,
+):
     from cards.config import Config, Credentials
     from cards.sync import sync
+    from cards.trace import Tracer
 
     config = Config.from_base(state.base)
     credentials = Credentials.from_base(state.base)
 
-    sync(credentials.mochi.token, state.base / config.path, config.decks)
+    tracer = Tracer()
+    try:
+        sync(
+            credentials.mochi.token,
+            state.base / config.path,
+            config.decks,
+            use_cache=cache,
+            jobs=jobs,
+            concurrency=concurrency,
+            full=full,
+            fast=fast,
+            confirm=not yes,
+            tracer=tracer,
+            image_encoding=config.images,
+        )
+    finally:
+        if trace is not None:
+            tracer.write(trace)
+            tracer.print_summary()
 
 
 @app.command()
-def preview():
+def preview(
+    build: Annotated[
+        None | Path,
+        typer.Option(
+            help="write html for all cards to this folder, instead of serving"
+        ),
+    ] = None,
+    jobs: Annotated[
+        int, typer.Option("--jobs", "-j", min=1, help="processes for local work")
+    ] = 1,
+):
     from cards.config import Config
-    from cards.preview import main
 
     config = Config.from_base(state.base)
 
-    main(state.base / config.path)
+    if build is not None:
+        from cards.build import build as build_all
+
+        build_all(state.base / config.path, list(config.decks), build, jobs)
+        return
+
+    from cards.preview import main
+
+    main(state.base / config.path, config.decks.keys())
 
 
 @app.command()
-def backup():
-    """backup all cards of the configured decks, raw, as json"""
-    from cards.backup import backup_deck
+def backup(
+    incremental: Annotated[
+        bool,
+        typer.Option(
+            "--incremental", help="only cards that changed since the last backup"
+        ),
+    ] = False,
+    concurrency: Annotated[
+        int, typer.Option("--concurrency", "-c", min=1, help="concurrent api requests")
+    ] = 4,
+    trace: Annotated[
+        None | Path,
+        typer.Option(help="write a chrome trace of phases and requests to this file"),
+    ] = None,
+):
+    """
+    backup all cards of the configured decks, raw, as gzipped json lines
+    and their attachments, decks and attachments concurrently
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from cards.api import MochiClient
+    from cards.backup import Attachments, backup_deck
     from cards.config import Config, Credentials
+    from cards.trace import Tracer
 
     config = Config.from_base(state.base)
     credentials = Credentials.from_base(state.base)
 
-    for deck_name, deck_id in config.decks.items():
-        backup_deck(credentials.mochi.token, deck_name, deck_id)
+    tracer = Tracer()
+    client = MochiClient.from_token(
+        credentials.mochi.token, pool_size=concurrency, tracer=tracer
+    )
+    attachments = Attachments.from_folder(Path("."))
+    try:
+        with (
+            ThreadPoolExecutor(concurrency) as downloads,
+            ThreadPoolExecutor(len(config.decks) or 1) as decks,
+        ):
+            backups = [
+                decks.submit(
+                    backup_deck,
+                    client,
+                    deck_name,
+                    deck_id,
+                    attachments,
+                    downloads,
+                    incremental,
+                    position=i,
+                )
+                for i, (deck_name, deck_id) in enumerate(config.decks.items())
+            ]
+            for backup in backups:
+                backup.result()
+    finally:
+        attachments.write_index()
+        print(client.scheduler.summary())
+        if trace is not None:
+            tracer.write(trace)
+            tracer.print_summary()
+
+
+@app.command()
+def restore(deck: str, out: Path):
+    """
+    merge the last full backup of a deck and the incremental ones after it
+    the result is a full backup itself
+    """
+    from cards.backup import restore, write_backup
+    from cards.config import Config
+
+    config = Config.from_base(state.base)
+
+    cards = restore(Path("."), config.decks[deck])
+    write_backup(out, cards.values())
+    print(f"wrote {len(cards)} cards to {out}")
 
 
 @app.command()
@@ -62,13 +195,12 @@ def rename(
     only renames, does not move, file stays in the same place
     NOTE only renames md files that are also in the meta.json, but not other connected files like images
     """
-    from cards.data import move
-
-    target = source.with_name(name)
-    move(state.base, source, target)
+    from cards.local import Abort, rename
 
-    if edit:
-        subprocess.run(["nvim", str(target)], check=True)
+    try:
+        rename(state.base, source, name, edit)
+    except Abort:
+        raise typer.Abort()
 
 
 @app.command()
@@ -79,29 +211,13 @@ def move(source: Path, deck: str):
     only cards that exist in meta.json can be moved
     images are also moved
     """
-    from cards.config import Config
-    from cards.data import move
-
-    config = Config.from_base(state.base)
-
-    if deck not in config.decks:
-        print(f"Deck {deck} does not exist.", file=sys.stderr)
-        raise typer.Abort()
+    from cards.local import Abort, move_to_deck
 
     try:
-        based_source = source.resolve(strict=True).relative_to(
-            state.base.resolve(strict=True)
-        )
-    except ValueError:
-        print(
-            f"Source {source} must be inside base {state.base}.",
-            file=sys.stderr,
-        )
+        move_to_deck(state.base, source, deck)
+    except Abort:
         raise typer.Abort()
 
-    target = state.base / deck / Path(*based_source.parts[1:])
-    move(state.base, source, target)
-
 
 @app.command()
 def show(path: Path):
@@ -125,16 +241,122 @@ def show(path: Path):
         print(f"image at {path}")
 
 
+@app.command()
+def bench_sync(
+    cards: Annotated[
+        None | list[int],
+        typer.Option(
+            "--cards",
+            help="collection sizes to run, 100, 1000 and 10000 by default",
+            show_default=False,
+        ),
+    ] = None,
+    latency: Annotated[float, typer.Option(help="seconds per request")] = 0.05,
+    error_rate: Annotated[float, typer.Option(help="fraction of 500s")] = 0,
+    throttle_rate: Annotated[float, typer.Option(help="fraction of 429s")] = 0,
+    jobs: Annotated[int, typer.Option("--jobs", "-j", min=1)] = 1,
+    concurrency: Annotated[int, typer.Option("--concurrency", "-c", min=1)] = 4,
+):
+    """
+    benchmark sync against a local fake of the mochi api
+    synthetic collections are generated inside base, which should be empty
+    NOTE card creation is not retried on errors, so a non-zero error rate can fail a run
+    """
+    from cards.bench import bench_sync, print_results
+    from cards.fake import Faults
+
+    faults = Faults(latency, error_rate, throttle_rate)
+    results = [
+        result
+        for n in cards or [100, 1000, 10000]
+        for result in bench_sync(state.base, n, faults, jobs, concurrency)
+    ]
+    print_results(results)
+
+
+@app.command()
+def bench_micro(
+    out: Annotated[
+        None | Path, typer.Option(help="write json here instead of stdout")
+    ] = None,
+    paragraphs: Annotated[
+        None | list[int],
+        typer.Option(help="1, 5 and 25 by default", show_default=False),
+    ] = None,
+    images: Annotated[
+        None | list[int], typer.Option(help="0, 1 and 4 by default", show_default=False)
+    ] = None,
+    repeat: Annotated[int, typer.Option(min=1)] = 20,
+):
+    """
+    benchmark the stages of making a card, results as json to compare versions
+    generated images are written inside base, which should be empty
+    """
+    import json
+
+    from cards.bench import bench_micro
+
+    results = bench_micro(
+        state.base, paragraphs or [1, 5, 25], images or [0, 1, 4], repeat
+    )
+    if out is None:
+        print(json.dumps(results, indent=4))
+    else:
+        out.write_text(json.dumps(results, indent=4))
+
+
+@app.command()
+def bench_scan():
+    """
+    check the markdown scanner against pandoc on all cards of the configured decks
+    and how long both take
+    """
+    import json
+
+    from cards.bench import bench_scan
+    from cards.config import Config
+
+    config = Config.from_base(state.base)
+
+    print(
+        json.dumps(bench_scan(state.base / config.path, list(config.decks)), indent=4)
+    )
+
+
+@app.command()
+def bench_startup(
+    modules: Annotated[
+        None | list[str],
+        typer.Option(
+            "--module",
+            help="modules to import, cards.local, cards.cli and cards.sync by default",
+            show_default=False,
+        ),
+    ] = None,
+    repeat: Annotated[int, typer.Option(min=1)] = 5,
+):
+    """
+    import time of modules in a fresh interpreter
+    cards.local is what move and rename need, it should stay well below 100 ms
+    """
+    import json
+
+    from cards.bench import bench_startup
+
+    modules = modules or ["cards.local", "cards.cli", "cards.sync"]
+    print(json.dumps(bench_startup(modules, repeat), indent=4))
+
+
 @app.command()
 def fetch(card_id: str):
     from pprint import pp
 
-    from cards.api import auth_from_token, raw_retrieve_card
+    from cards.api import MochiClient, raw_retrieve_card
     from cards.config import Credentials
 
     credentials = Credentials.from_base(state.base)
-    auth = auth_from_token(credentials.mochi.token)
+    client = MochiClient.from_token(credentials.mochi.token)
 
-    card = raw_retrieve_card(auth, card_id)
+    card = raw_retrieve_card(client, card_id)
 
     pp(card)
@@ -1,12 +1,27 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 
 from serde import serde
 from serde.toml import from_toml
 
 
+@serde
+@dataclass(frozen=True)
+class ImageEncoding:
+    # NOTE wider images are scaled down
+    max_width: int = 800
+    # NOTE lossy formats the destination accepts, "jpeg" or "webp"
+    # lossless images are always png, lossy ones are only used for photos
+    lossy_formats: tuple[str, ...] = ("jpeg",)
+    quality: int = 85
+
+    def __post_init__(self):
+        assert set(self.lossy_formats) <= {"jpeg", "webp"}, self.lossy_formats
+        assert 0 < self.quality <= 100, self.quality
+
+
 @serde
 @dataclass
 class Config:
@@ -19,6 +34,9 @@ class Config:
     # NOTE only folder that are mentioned here are synced
     decks: dict[str, str]
 
+    # NOTE how images are encoded for mochi, as an optional [images] table
+    images: ImageEncoding = field(default_factory=ImageEncoding)
+
     @classmethod
     def from_base(cls, base: Path):
         return from_toml(cls, (base / "config.toml").read_text())
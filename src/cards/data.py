@@ -1,21 +1,27 @@
 from __future__ import annotations
 
-import sys
-from collections.abc import Set
+import os
+import re
+from collections.abc import Callable, Iterator, Sequence, Set
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import partial
 from hashlib import sha256
 from io import BytesIO
+from math import ceil
+from multiprocessing import get_context
 from pathlib import Path
-from shutil import copyfile
+from typing import assert_never
 
-import typer
+import PIL
 from PIL import Image
-from serde import serde
-from serde.json import from_json, to_json
 from tqdm import tqdm
 
 from cards.api import Attachment
-from cards.markdown import Direction, Markdown
+from cards.cache import Cache, key_from
+from cards.config import ImageEncoding
+from cards.markdown import Markdown, as_mochi_md_strs, pandoc_version, reader
+from cards.meta import Direction, Meta
 
 
 # TODO same name as api.Card ... can we have a better name here?
@@ -27,53 +33,83 @@ class Card:
     path: Path
     direction: Direction
 
+    def attachments_changed_from(self, content: str) -> list[Attachment]:
+        """attachments that are not already referenced in content with the same hash"""
+        before = media_hashes(content)
+        after = media_hashes(self.content)
+        return [
+            a
+            for a in self.attachments
+            if a.file_name not in after or before.get(a.file_name) != after[a.file_name]
+        ]
 
-@serde
-class Meta:
-    forward: None | str
-    backward: None | str
 
-    def set_by_direction(self, direction: Direction, value: None | str):
-        match direction:
-            case Direction.forward:
-                self.forward = value
-            case Direction.backward:
-                self.backward = value
-            case _:
-                assert False
+# NOTE how many documents we give to one pandoc process
+# smaller batches give a more responsive progress bar and cheaper bisecting on failures
+batch_size = 64
 
-    def get_by_direction(self, direction: Direction) -> None | str:
-        match direction:
-            case Direction.forward:
-                return self.forward
-            case Direction.backward:
-                return self.backward
-            case _:
-                assert False
 
+def in_batches[T](items: Sequence[T], jobs: int) -> list[Sequence[T]]:
+    # NOTE smaller batches if needed so that all jobs get some work
+    size = max(1, min(batch_size, ceil(len(items) / jobs)))
+    return [items[at : at + size] for at in range(0, len(items), size)]
 
-def read_markdowns(base: Path, decks: Set[str]) -> dict[Path, Markdown]:
-    """return paths are relative to base"""
-    paths = [path for deck in decks for path in (base / deck).rglob("*.md")]
-    return {
-        path.relative_to(base): Markdown.from_path(path)
-        for path in tqdm(paths, desc="read markdowns")
-    }
 
+# NOTE not forked, we have threads running by now, like the listing during sync
+# a fork copies their locks in whatever state they are in
+# workers fork from a server that has already imported most of what we need
+# but not pandoc, plumbum starts a thread on import
+forkserver = get_context("forkserver")
+forkserver.set_forkserver_preload(["cards.api", "cards.config", "PIL.Image"])
 
-def read_meta(base: Path) -> dict[Path, Meta]:
-    at = base / "meta.json"
-    if not at.exists():
-        return {}
-    meta_str = from_json(dict[str, Meta], at.read_text())
-    meta = {Path(p): m for p, m in meta_str.items()}
-    return meta
 
+def map_in_processes[T, R](
+    f: Callable[[T], R], items: Sequence[T], jobs: int
+) -> Iterator[R]:
+    """like map, in order, but with a process pool for jobs > 1"""
+    if jobs <= 1:
+        yield from map(f, items)
+        return
+    with ProcessPoolExecutor(jobs, mp_context=forkserver) as pool:
+        yield from pool.map(f, items)
+
+
+def read_markdowns(
+    base: Path, decks: Set[str], cache: Cache, jobs: int = 1
+) -> dict[Path, Markdown]:
+    """return paths are relative to base"""
+    paths = [path for deck in decks for path in (base / deck).rglob("*.md")]
+    texts = [path.read_text() for path in paths]
+    # NOTE the pandoc version is part of the key, the ast might differ between versions
+    version = pandoc_version()
+    keys = [key_from(version, reader, text) for text in texts]
+
+    markdowns: list[None | Markdown] = []
+    for key in keys:
+        body = cache.get(key)
+        assert body is None or type(body) is list, type(body)
+        markdowns.append(None if body is None else Markdown(body))
+
+    missing = in_batches([i for i, m in enumerate(markdowns) if m is None], jobs)
+    parsed = map_in_processes(
+        Markdown.from_strs, [[texts[i] for i in batch] for batch in missing], jobs
+    )
+    with tqdm(
+        total=len(paths),
+        initial=len(paths) - sum(map(len, missing)),
+        desc="read markdowns",
+    ) as progress:
+        for batch, batch_markdowns in zip(missing, parsed):
+            for i, markdown in zip(batch, batch_markdowns):
+                cache.put(keys[i], markdown.body)
+                markdowns[i] = markdown
+            progress.update(len(batch))
 
-def write_meta(base: Path, meta: dict[Path, Meta]):
-    # NOTE we sort it so that it's a bit more stable in a potential git diff
-    meta_str = {str(p): m for p, m in sorted(meta.items())}
-    (base / "meta.json").write_text(to_json(meta_str, indent=4))
+    return {
+        path.relative_to(base): markdown
+        for path, markdown in zip(paths, markdowns)
+        if markdown is not None
+    }
 
 
 def get_synced_meta(
@@ -126,42 +162,49 @@ class MetaDiff:
 
 
 def get_cards(
-    base: Path, markdowns: dict[Path, Markdown], meta: dict[Path, Meta]
+    base: Path,
+    markdowns: dict[Path, Markdown],
+    meta: dict[Path, Meta],
+    image_cache: Cache,
+    jobs: int = 1,
+    encoding: ImageEncoding = ImageEncoding(),
 ) -> tuple[dict[str, Card], list[Card]]:
     existing_cards: dict[str, Card] = dict()
     new_cards: list[Card] = []
 
-    for path, markdown in tqdm(markdowns.items(), desc="make cards"):
-        images = Images.from_base(base / path.parent)
-        markdown = markdown.with_rewritten_images(images.collect)
-
-        card = Card(
-            content=markdown.maybe_prompted().as_mochi_md_str(),
-            deck_name=path.parts[0],
-            attachments=images.as_api_attachments(),
-            path=path,
-            direction=Direction.forward,
+    # NOTE every image once, no matter how many cards use it
+    # on threads, pillow releases the gil while decoding, resizing and encoding
+    image_paths = {
+        path: image_paths_of(base, path, markdown)
+        for path, markdown in markdowns.items()
+    }
+    unique = list({p for paths in image_paths.values() for p in paths})
+    images = Images.from_base(base, image_cache, encoding=encoding)
+    with ThreadPoolExecutor(jobs) as pool:
+        encoded = dict(zip(unique, pool.map(images.encode, unique)))
+    if len(encoded) > 0:
+        size = sum(len(e.data) for e in encoded.values())
+        saved = sum(e.plain_size for e in encoded.values()) - size
+        print(
+            f"{len(encoded)} images are {size / 1000:.0f} kB,"
+            f" {saved / 1000:.0f} kB less than as plain png"
         )
 
-        match meta.get(path, Meta(None, None)).forward:
-            case None:
-                new_cards.append(card)
-            case str(card_id):
-                assert card_id not in existing_cards, card_id
-                existing_cards[card_id] = card
-            case _ as never:
-                assert_never(never)
-
-        if markdown.has_reverse_prompt():
-            card = Card(
-                content=markdown.reversed().maybe_prompted().as_mochi_md_str(),
-                deck_name=path.parts[0],
-                attachments=images.as_api_attachments(),
-                path=path,
-                direction=Direction.backward,
-            )
-
-            match meta.get(path, Meta(None, None)).backward:
+    batches = [
+        [
+            (path, markdown, {p: encoded[p] for p in image_paths[path]})
+            for path, markdown in batch
+        ]
+        for batch in in_batches(list(markdowns.items()), jobs)
+    ]
+    made = map_in_processes(
+        partial(make_cards, base, image_cache, encoding), batches, jobs
+    )
+    for cards in tqdm(made, total=len(batches), desc="make cards"):
+        for card in cards:
+            match meta.get(card.path, Meta(None, None)).get_by_direction(
+                card.direction
+            ):
                 case None:
                     new_cards.append(card)
                 case str(card_id):
@@ -173,100 +216,181 @@ def get_cards(
     return existing_cards, new_cards
 
 
-@dataclass
-class Images:
-    base: Path
-    next_index: int
-    data: dict[str, bytes]
-    max_width: int = 800
+def image_paths_of(base: Path, path: Path, markdown: Markdown) -> list[Path]:
+    """normalized, so that different ways to the same image are the same"""
+    return [
+        Path(os.path.normpath(base / path.parent / ip))
+        for ip in markdown.get_image_paths()
+    ]
 
-    @classmethod
-    def from_base(cls, base: Path):
-        return cls(base, 0, {})
 
-    def collect(self, path: str) -> tuple[str, str]:
-        local = self.base / path
-        # TODO mochis requirements on names here a bit arbitrary, and not correctly documented too
-        name = f"i{self.next_index:08}.png"
-        remote = f"@media/{name}"
-        self.next_index += 1
+def make_cards(
+    base: Path,
+    image_cache: Cache,
+    encoding: ImageEncoding,
+    markdowns: Sequence[tuple[Path, Markdown, dict[Path, Encoded]]],
+) -> list[Card]:
+    """
+    all cards of all directions, with the mochi content written in one batch
+    images are already encoded, by their normalized path, see image_paths_of
+    """
+    todo: list[tuple[Path, Direction, Markdown, Images]] = []
+    for path, markdown, encoded in markdowns:
+        images = Images.from_base(base / path.parent, image_cache, encoded, encoding)
+        markdown = markdown.with_rewritten_images(images.collect)
+        todo.append((path, Direction.forward, markdown.maybe_prompted(), images))
+        if markdown.has_reverse_prompt():
+            todo.append(
+                (path, Direction.backward, markdown.reversed().maybe_prompted(), images)
+            )
 
-        with Image.open(local) as image:
-            if image.width > self.max_width:
-                height = round(image.height * self.max_width / image.width)
-                image = image.resize((self.max_width, height))
-            data = BytesIO()
-            image.save(data, "png")
-            self.data[name] = data.getvalue()
+    contents = as_mochi_md_strs([markdown for _, _, markdown, _ in todo])
 
-        hash = sha256()
-        hash.update(self.data[name])
+    return [
+        Card(
+            content=content,
+            deck_name=path.parts[0],
+            attachments=images.as_api_attachments(),
+            path=path,
+            direction=direction,
+        )
+        for (path, direction, _, images), content in zip(todo, contents)
+    ]
 
-        return remote, hash.hexdigest()
 
-    def as_api_attachments(self) -> list[Attachment]:
-        return [Attachment(name, data) for name, data in self.data.items()]
+# NOTE matches images as written by Images.collect and as_mochi_md_str
+# ![...](@media/name "hash")
+media_pattern = re.compile(r'\(@media/([^\s)]+) "([0-9a-f]{64})"\)')
 
 
-def move(base: Path, source: Path, target: Path):
-    """
-    this is verbose and validates things
-    can be used to move and/or rename
-    """
+def media_hashes(content: str) -> dict[str, str]:
+    """attachment file name -> hash of its data, as referenced in content"""
+    return {name: hash for name, hash in media_pattern.findall(content)}
 
-    if not source.exists():
-        print("Source does not exist.", file=sys.stderr)
-        raise typer.Abort()
 
-    if target.exists():
-        print(f"Target {target} already exists.", file=sys.stderr)
-        raise typer.Abort()
+# NOTE change this when changing how images are encoded, it invalidates cached images
+image_encoder = f"smallest-of-png-palette-lossy-pillow-{PIL.__version__}"
+
+extensions = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+# NOTE lossy formats blur edges, we only take them when they are a lot smaller
+# which is the case for photos, but hardly for drawings or screenshots
+lossy_ratio = 0.5
 
-    # NOTE we need to resolve everything so that we can compute relative paths reliably
-    base = base.resolve(strict=True)
-    try:
-        based_source = source.resolve(strict=True).relative_to(base)
-        based_target = target.resolve(strict=False).relative_to(base)
-    except ValueError:
-        print(
-            f"Source {source} and target {target} must be inside base {base}.",
-            file=sys.stderr,
-        )
-        raise typer.Abort()
-
-    if based_source == based_target:
-        print("Source and target cannot be the same.", file=sys.stderr)
-        raise typer.Abort()
-
-    meta = read_meta(base)
-
-    if based_source not in meta:
-        print(f"Source {based_source} is not in {base / 'meta.json'}.", file=sys.stderr)
-        raise typer.Abort()
-
-    meta[based_target] = meta.pop(based_source)
-
-    image_paths = Markdown.from_path(base / based_source).get_image_paths()
-    if based_source.parent != based_target.parent:
-        for ip in image_paths:
-            if (base / based_target.parent / ip).exists():
-                print(
-                    f"Image at {base / based_target.parent / ip} already exists.",
-                    file=sys.stderr,
-                )
-                raise typer.Abort()
-
-    print(f"{base / based_source} -> {base / based_target}")
-    copyfile(base / based_source, base / based_target)
-    if based_source.parent != based_target.parent:
-        for ip in image_paths:
-            print(
-                f"{base / based_source.parent / ip} -> {base / based_target.parent / ip}"
-            )
-            copyfile(base / based_source.parent / ip, base / based_target.parent / ip)
 
-    (base / based_source).unlink()
-    for ip in image_paths:
-        (base / based_source.parent / ip).unlink()
+@dataclass
+class Encoded:
+    data: bytes
+    hash: str  # sha256 of data
+    format: str
+    # NOTE what it would have been as a plain png, to report what we saved
+    plain_size: int
+
+
+def save(image: Image.Image, format: str, **options) -> bytes:
+    data = BytesIO()
+    image.save(data, format, **options)
+    return data.getvalue()
+
+
+def as_palette(image: Image.Image) -> None | Image.Image:
+    """the same image with a palette, None if it has too many colors for one"""
+    if image.mode not in ("RGB", "RGBA") or image.getcolors(256) is None:
+        return None
+    palette = image.quantize(256, dither=Image.Dither.NONE)
+    # NOTE quantizing may still merge close colors, we only want it lossless
+    if palette.convert(image.mode).tobytes() != image.tobytes():
+        return None
+    return palette
+
+
+def as_opaque(image: Image.Image) -> None | Image.Image:
+    """the image as rgb or grayscale, None if it has transparent pixels"""
+    if image.has_transparency_data:
+        image = image.convert("RGBA")
+        if image.getchannel("A").getextrema() != (255, 255):
+            return None
+    return image if image.mode in ("RGB", "L") else image.convert("RGB")
+
+
+def encode_image(source: bytes, encoding: ImageEncoding) -> Encoded:
+    """scaled down to max_width, as the smallest format the encoding allows"""
+    with Image.open(BytesIO(source)) as image:
+        width, height = image.size
+        if width > encoding.max_width:
+            size = (encoding.max_width, round(height * encoding.max_width / width))
+            # NOTE jpegs decode directly at a fraction of their size, much faster
+            image.draft(None, size)
+            # NOTE reduces by an integer factor first, then resamples only the rest
+            image = image.resize(size, reducing_gap=2.0)
+        else:
+            image.load()
+
+    plain = save(image, "png")
+    candidates = [("png", plain)]
+    palette = as_palette(image)
+    if palette is not None:
+        candidates.append(("png", save(palette, "png", optimize=True)))
+    opaque = as_opaque(image) if palette is None else None
+    if opaque is not None:
+        for format in encoding.lossy_formats:
+            options = {"optimize": True} if format == "jpeg" else {}
+            data = save(opaque, format, quality=encoding.quality, **options)
+            if len(data) <= len(plain) * lossy_ratio:
+                candidates.append((format, data))
+    # NOTE optimizing takes long and gains little, not worth it when lossy won anyway
+    if len(candidates) == 1:
+        candidates.append(("png", save(image, "png", optimize=True)))
+
+    format, data = min(candidates, key=lambda c: len(c[1]))
+    return Encoded(data, sha256(data).hexdigest(), format, len(plain))
+
+
+@dataclass
+class Images:
+    base: Path
+    cache: Cache
+    # NOTE by normalized path, so that each image is encoded once
+    encoded: dict[Path, Encoded]
+    data: dict[str, bytes]
+    encoding: ImageEncoding
 
-    write_meta(base, meta)
+    @classmethod
+    def from_base(
+        cls,
+        base: Path,
+        cache: Cache,
+        encoded: None | dict[Path, Encoded] = None,
+        encoding: ImageEncoding = ImageEncoding(),
+    ):
+        return cls(base, cache, {} if encoded is None else encoded, {}, encoding)
+
+    def collect(self, path: str) -> tuple[str, str]:
+        local = Path(os.path.normpath(self.base / path))
+        if local not in self.encoded:
+            self.encoded[local] = self.encode(local)
+        encoded = self.encoded[local]
+
+        # NOTE named by content, so that reordering images in a card changes nothing
+        # and the same image twice in a card is one attachment
+        # TODO mochis requirements on names here a bit arbitrary, and not correctly documented too
+        name = f"{encoded.hash[:16]}.{extensions[encoded.format]}"
+        self.data[name] = encoded.data
+        return f"@media/{name}", encoded.hash
+
+    def encode(self, local: Path) -> Encoded:
+        """cached by source content and settings"""
+        source = local.read_bytes()
+        # NOTE everything that changes the encoded result must be part of the key
+        key = key_from(image_encoder, str(self.encoding), source)
+        cached = self.cache.get(key)
+        if cached is not None:
+            assert type(cached) is Encoded, type(cached)
+            return cached
+
+        encoded = encode_image(source, self.encoding)
+        self.cache.put(key, encoded)
+        return encoded
+
+    def as_api_attachments(self) -> list[Attachment]:
+        return [Attachment(name, data) for name, data in self.data.items()]
@@ -0,0 +1,193 @@
+"""
+a local stand-in for the parts of the mochi api that we use
+with configurable latency, errors and throttling
+good enough to measure sync, not a faithful reimplementation
+"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import random
+import threading
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass, field
+from itertools import count
+
+from flask import Flask, Response, current_app, request
+from werkzeug.serving import BaseWSGIServer, make_server
+
+app = Flask(__name__)
+
+
+@dataclass
+class Faults:
+    latency: float = 0  # seconds added to every request
+    error_rate: float = 0  # fraction of requests that fail with 500
+    throttle_rate: float = 0  # fraction of requests that fail with 429
+    retry_after: float = 1  # seconds, sent with 429
+
+
+@dataclass
+class Stats:
+    requests: int = 0
+    bytes_received: int = 0
+    bytes_sent: int = 0
+    errors: int = 0
+    throttled: int = 0
+
+
+@dataclass
+class FakeMochi:
+    faults: Faults = field(default_factory=Faults)
+    stats: Stats = field(default_factory=Stats)
+    cards: dict[str, dict] = field(default_factory=dict)
+    # NOTE card id -> file name -> data
+    attachments: dict[str, dict[str, bytes]] = field(default_factory=dict)
+    ids: Iterator[int] = field(default_factory=count)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def new_id(self) -> str:
+        with self.lock:
+            return f"fake{next(self.ids):08}"
+
+
+def mochi() -> FakeMochi:
+    return current_app.config["mochi"]
+
+
+def now() -> str:
+    return datetime.datetime.now(datetime.UTC).isoformat()
+
+
+@app.before_request
+def inject_faults():
+    m = mochi()
+    with m.lock:
+        m.stats.requests += 1
+        m.stats.bytes_received += len(request.get_data())
+    time.sleep(m.faults.latency)
+    if random.random() < m.faults.throttle_rate:
+        with m.lock:
+            m.stats.throttled += 1
+        return "throttled", 429, {"Retry-After": str(m.faults.retry_after)}
+    if random.random() < m.faults.error_rate:
+        with m.lock:
+            m.stats.errors += 1
+        return "injected error", 500
+
+
+@app.after_request
+def count_bytes(response: Response) -> Response:
+    m = mochi()
+    with m.lock:
+        m.stats.bytes_sent += len(response.get_data())
+    return response
+
+
+@app.get("/api/cards")
+def list_cards():
+    m = mochi()
+    deck_id = request.args.get("deck-id")
+    limit = min(int(request.args.get("limit", 10)), 100)
+    start = int(request.args.get("bookmark") or 0)
+    with m.lock:
+        docs = [c for c in m.cards.values() if deck_id in (None, c["deck-id"])]
+    # NOTE the real bookmarks are opaque, we use an offset
+    return {"bookmark": str(start + limit), "docs": docs[start : start + limit]}
+
+
+@app.post("/api/cards")
+def create_card():
+    m = mochi()
+    body = request.get_json()
+    id = m.new_id()
+    card = {
+        "id": id,
+        "content": body["content"],
+        "deck-id": body["deck-id"],
+        "created-at": now(),
+        "updated-at": now(),
+    }
+    with m.lock:
+        m.cards[id] = card
+        m.attachments[id] = {}
+    return card
+
+
+@app.get("/api/cards/<id>")
+def retrieve_card(id: str):
+    m = mochi()
+    with m.lock:
+        if id not in m.cards:
+            return "not found", 404
+        return m.cards[id]
+
+
+@app.post("/api/cards/<id>")
+def update_card(id: str):
+    m = mochi()
+    with m.lock:
+        if id not in m.cards:
+            return "not found", 404
+        m.cards[id] |= request.get_json() | {"updated-at": now()}
+        return m.cards[id]
+
+
+@app.delete("/api/cards/<id>")
+def delete_card(id: str):
+    m = mochi()
+    with m.lock:
+        if id not in m.cards:
+            return "not found", 404
+        m.cards.pop(id)
+        m.attachments.pop(id)
+    return {}
+
+
+@app.get("/api/cards/<id>/attachments/<file_name>")
+def retrieve_attachment(id: str, file_name: str):
+    m = mochi()
+    with m.lock:
+        if file_name not in m.attachments.get(id, {}):
+            return "not found", 404
+        return m.attachments[id][file_name]
+
+
+@app.post("/api/cards/<id>/attachments/<file_name>")
+def update_attachment(id: str, file_name: str):
+    m = mochi()
+    data = request.files["file"].read()
+    with m.lock:
+        if id not in m.cards:
+            return "not found", 404
+        m.attachments[id][file_name] = data
+    return {}
+
+
+@dataclass
+class FakeServer:
+    """runs the fake in a background thread, on a free port"""
+
+    mochi: FakeMochi
+    server: BaseWSGIServer
+    thread: threading.Thread
+
+    @classmethod
+    def start(cls, faults: None | Faults = None):
+        mochi = FakeMochi(faults or Faults())
+        app.config["mochi"] = mochi
+        # NOTE otherwise every request is logged
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        return cls(mochi, server, thread)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_port}/api/"
+
+    def stop(self):
+        self.server.shutdown()
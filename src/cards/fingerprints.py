@@ -0,0 +1,131 @@
+"""
+fingerprints of what went into the cards of the last successful sync
+if nothing changed for a file, we dont need to make its cards again
+as long as the remote cards still have the content we made back then
+"""
+
+from __future__ import annotations
+
+from collections.abc import Iterable
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+
+from serde import serde
+from serde.json import from_json, to_json
+
+from cards.cache import key_from
+from cards.config import ImageEncoding
+from cards.data import Card, image_encoder
+from cards.markdown import Markdown, pandoc_version
+from cards.meta import Direction, Meta
+
+
+@serde
+@dataclass
+class Fingerprint:
+    # NOTE hash of everything global that changes how cards are made
+    settings: str
+    # NOTE sha256 of the markdown file
+    source: str
+    # NOTE image path relative to the markdown file -> sha256 of the image file
+    images: dict[str, str]
+    # NOTE direction -> sha256 of the card content as sent to mochi
+    contents: dict[str, str]
+
+
+def hash_of(data: bytes | str) -> str:
+    if isinstance(data, str):
+        data = data.encode()
+    return sha256(data).hexdigest()
+
+
+def get_settings(encoding: ImageEncoding) -> str:
+    return key_from(pandoc_version(), image_encoder, str(encoding))
+
+
+# NOTE relative to base, the static build keeps its own in its output folder
+default_name = Path(".cache") / "fingerprints.json"
+
+
+def read_fingerprints(base: Path, name: Path = default_name) -> dict[Path, Fingerprint]:
+    at = base / name
+    if not at.exists():
+        return {}
+    return {
+        Path(p): f for p, f in from_json(dict[str, Fingerprint], at.read_text()).items()
+    }
+
+
+def write_fingerprints(
+    base: Path, fingerprints: dict[Path, Fingerprint], name: Path = default_name
+):
+    at = base / name
+    at.parent.mkdir(parents=True, exist_ok=True)
+    fingerprints_str = {str(p): f for p, f in sorted(fingerprints.items())}
+    at.write_text(to_json(fingerprints_str))
+
+
+def get_inputs(
+    base: Path, markdowns: dict[Path, Markdown]
+) -> dict[Path, tuple[str, dict[str, str]]]:
+    """path -> hash of the source, and hashes of its images"""
+    return {
+        path: (
+            hash_of((base / path).read_bytes()),
+            {
+                str(ip): hash_of((base / path.parent / ip).read_bytes())
+                for ip in markdown.get_image_paths()
+            },
+        )
+        for path, markdown in markdowns.items()
+    }
+
+
+def get_unchanged(
+    meta: dict[Path, Meta],
+    inputs: dict[Path, tuple[str, dict[str, str]]],
+    fingerprints: dict[Path, Fingerprint],
+    settings: str,
+) -> dict[str, tuple[Path, str]]:
+    """
+    card id -> path and content hash, for cards whose inputs did not change
+    cards without an id are never unchanged, they still need to be created
+    """
+    unchanged: dict[str, tuple[Path, str]] = dict()
+    for path, (source, images) in inputs.items():
+        fingerprint = fingerprints.get(path)
+        if fingerprint is None:
+            continue
+        if (fingerprint.settings, fingerprint.source, fingerprint.images) != (
+            settings,
+            source,
+            images,
+        ):
+            continue
+        ids = {
+            direction.value: id
+            for direction in Direction
+            if (id := meta.get(path, Meta(None, None)).get_by_direction(direction))
+            is not None
+        }
+        if set(ids) != set(fingerprint.contents):
+            continue
+        for direction, id in ids.items():
+            unchanged[id] = (path, fingerprint.contents[direction])
+    return unchanged
+
+
+def get_fingerprints(
+    inputs: dict[Path, tuple[str, dict[str, str]]],
+    cards: Iterable[Card],
+    settings: str,
+) -> dict[Path, Fingerprint]:
+    fingerprints: dict[Path, Fingerprint] = dict()
+    for card in cards:
+        source, images = inputs[card.path]
+        fingerprint = fingerprints.setdefault(
+            card.path, Fingerprint(settings, source, images, {})
+        )
+        fingerprint.contents[card.direction.value] = hash_of(card.content)
+    return fingerprints
@@ -0,0 +1,150 @@
+"""
+commands that only touch local files, our editor runs them all the time
+so this module and its imports are kept light, no typer, serde, pandoc or pillow
+__main__ runs them directly, without going through the full cli
+"""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+import tomllib
+from pathlib import Path
+from shutil import copyfile
+
+from cards.meta import read_meta, write_meta
+from cards.scan import get_image_paths
+
+
+class Abort(Exception):
+    """the message was already printed, the cli turns this into typer.Abort"""
+
+
+def move(base: Path, source: Path, target: Path):
+    """
+    this is verbose and validates things
+    can be used to move and/or rename
+    """
+
+    if not source.exists():
+        print("Source does not exist.", file=sys.stderr)
+        raise Abort()
+
+    if target.exists():
+        print(f"Target {target} already exists.", file=sys.stderr)
+        raise Abort()
+
+    # NOTE we need to resolve everything so that we can compute relative paths reliably
+    base = base.resolve(strict=True)
+    try:
+        based_source = source.resolve(strict=True).relative_to(base)
+        based_target = target.resolve(strict=False).relative_to(base)
+    except ValueError:
+        print(
+            f"Source {source} and target {target} must be inside base {base}.",
+            file=sys.stderr,
+        )
+        raise Abort()
+
+    if based_source == based_target:
+        print("Source and target cannot be the same.", file=sys.stderr)
+        raise Abort()
+
+    meta = read_meta(base)
+
+    if based_source not in meta:
+        print(f"Source {based_source} is not in {base / 'meta.json'}.", file=sys.stderr)
+        raise Abort()
+
+    meta[based_target] = meta.pop(based_source)
+
+    image_paths = get_image_paths((base / based_source).read_text())
+    if based_source.parent != based_target.parent:
+        for ip in image_paths:
+            # NOTE checked before we copy anything, so that we never half move a card
+            if not (base / based_source.parent / ip).exists():
+                print(
+                    f"Image at {base / based_source.parent / ip} does not exist.",
+                    file=sys.stderr,
+                )
+                raise Abort()
+            if (base / based_target.parent / ip).exists():
+                print(
+                    f"Image at {base / based_target.parent / ip} already exists.",
+                    file=sys.stderr,
+                )
+                raise Abort()
+
+    print(f"{base / based_source} -> {base / based_target}")
+    copyfile(base / based_source, base / based_target)
+    if based_source.parent != based_target.parent:
+        for ip in image_paths:
+            print(
+                f"{base / based_source.parent / ip} -> {base / based_target.parent / ip}"
+            )
+            copyfile(base / based_source.parent / ip, base / based_target.parent / ip)
+
+    (base / based_source).unlink()
+    for ip in image_paths:
+        (base / based_source.parent / ip).unlink()
+
+    write_meta(base, meta)
+
+
+def rename(base: Path, source: Path, name: str, edit: bool = False):
+    target = source.with_name(name)
+    move(base, source, target)
+
+    if edit:
+        subprocess.run(["nvim", str(target)], check=True)
+
+
+def move_to_deck(base: Path, source: Path, deck: str):
+    # NOTE tomllib instead of Config, which needs serde
+    decks = tomllib.loads((base / "config.toml").read_text())["decks"]
+
+    if deck not in decks:
+        print(f"Deck {deck} does not exist.", file=sys.stderr)
+        raise Abort()
+
+    try:
+        based_source = source.resolve(strict=True).relative_to(
+            base.resolve(strict=True)
+        )
+    except ValueError:
+        print(
+            f"Source {source} must be inside base {base}.",
+            file=sys.stderr,
+        )
+        raise Abort()
+
+    target = base / deck / Path(*based_source.parts[1:])
+    move(base, source, target)
+
+
+def main(args: list[str]) -> bool:
+    """
+    runs move or rename if args are exactly one of those, with no other options
+    false for anything else, like --help, then the full cli handles it
+    """
+    try:
+        match args:
+            case [base, "move", source, deck] if not any(
+                a.startswith("-") for a in args
+            ):
+                move_to_deck(Path(base), Path(source), deck)
+            case [base, "rename", source, name, *options] if set(options) <= {
+                "-e",
+                "--edit",
+                "--no-edit",
+            } and not any(a.startswith("-") for a in [base, source, name]):
+                # NOTE the last one wins, like with click
+                edit = next((o != "--no-edit" for o in reversed(options)), False)
+                rename(Path(base), Path(source), name, edit)
+            case _:
+                return False
+    except Abort:
+        # NOTE the same as click does for typer.Abort
+        print("Aborted!", file=sys.stderr)
+        sys.exit(1)
+    return True
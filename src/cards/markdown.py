@@ -8,30 +8,37 @@ type-safe interface for the rest of the code base
 
 from __future__ import annotations
 
-from collections.abc import Callable, Iterator
+from collections.abc import Callable, Iterator, Sequence
 from copy import deepcopy
 from dataclasses import dataclass
-from enum import Enum
 from pathlib import Path
+from uuid import uuid4
 
 import pandoc
 from pandoc.types import (
     Block,  # pyright: ignore
     Emph,  # pyright: ignore
+    Header,  # pyright: ignore
     HorizontalRule,  # pyright: ignore
     Image,  # pyright: ignore
     Inline,  # pyright: ignore
+    Link,  # pyright: ignore
     Meta,  # pyright: ignore
+    Note,  # pyright: ignore
     Pandoc,  # pyright: ignore
     Para,  # pyright: ignore
     Space,  # pyright: ignore
     Str,  # pyright: ignore
 )
 
+from cards.meta import Direction
 
-class Direction(Enum):
-    forward = "forward"
-    backward = "backward"
+
+def pandoc_version() -> str:
+    """the pandoc program is configured when pandoc.types is imported"""
+    configuration = pandoc.configure(read=True)
+    assert configuration is not None
+    return configuration["version"]
 
 
 @dataclass
@@ -40,35 +47,29 @@ class Markdown:
 
     @classmethod
     def from_str(cls, text: str):
-        _, body = pandoc.read(text, format="markdown")  # pyright: ignore
-        assert type(body) is list, type(body)
-        return cls(body)
+        return cls(read_body(text))
+
+    @classmethod
+    def from_strs(cls, texts: Sequence[str]) -> list[Markdown]:
+        """same as from_str for each text, but with as few pandoc processes as possible"""
+        return [cls(body) for body in read_bodies(texts)]
 
     @classmethod
     def from_path(cls, path: Path):
         return cls.from_str(path.read_text())
 
     def as_mochi_md_str(self) -> str:
-        data = pandoc.write(
-            Pandoc(Meta({}), self.body),
-            format="markdown+hard_line_breaks",
-            # NOTE columns=3 and wrap=none forces rulers to be exactly 3 dashes (---)
-            # mochi accepts only exactly 3 dashes (---) as a new page
-            options=["--columns=3", "--wrap=none"],
-        )
-        # TODO note sure in what case we get what
-        assert type(data) is str, type(data)
+        [data] = as_mochi_md_strs([self])
         return data
 
     def as_formatted(self) -> str:
-        formatted = pandoc.write(
-            Pandoc(Meta({}), self.body),  # pyright: ignore[reportAttributeAccessIssue]
-            # NOTE this is the format i use in nvim too
-            format="markdown",
-        )
-        assert type(formatted) is str, type(formatted)
+        [formatted] = as_formatted_strs([self])
         return formatted
 
+    def as_html(self, options: list[str]) -> str:
+        """pandoc html, options can make it a full document, see preview"""
+        return write_body(self.body, format="html", options=options)
+
     def reversed(self) -> Markdown:
         first, second = split_blocks(self.body)
         return Markdown(second + [HorizontalRule()] + first)
@@ -134,6 +135,130 @@ class Markdown:
         return list(g())
 
 
+def as_mochi_md_strs(markdowns: Sequence[Markdown]) -> list[str]:
+    return write_bodies(
+        [m.body for m in markdowns],
+        format="markdown+hard_line_breaks",
+        # NOTE columns=3 and wrap=none forces rulers to be exactly 3 dashes (---)
+        # mochi accepts only exactly 3 dashes (---) as a new page
+        options=["--columns=3", "--wrap=none"],
+    )
+
+
+def as_formatted_strs(markdowns: Sequence[Markdown]) -> list[str]:
+    # NOTE this is the format i use in nvim too
+    return write_bodies([m.body for m in markdowns], format="markdown", options=[])
+
+
+# NOTE batches of documents are joined with this paragraph in between
+# it cannot appear in a card, so splitting on it is safe
+batch_separator = f"cards-batch-separator-{uuid4().hex}"
+
+
+def read_body(text: str) -> list[Block]:
+    _, body = pandoc.read(text, format="markdown")  # pyright: ignore
+    assert type(body) is list, type(body)
+    return body
+
+
+# NOTE change this when changing how texts are read, it invalidates cached asts
+reader = "joined-unless-dependent-2"
+
+
+def read_bodies(texts: Sequence[str]) -> list[list[Block]]:
+    joinable = [i for i, text in enumerate(texts) if is_joinable(text)]
+    bodies: list[None | list[Block]] = [None] * len(texts)
+    for i, body in zip(joinable, read_joined([texts[i] for i in joinable])):
+        # NOTE header ids are deduplicated over the whole document
+        # and headers can be referenced from other documents, read those alone
+        bodies[i] = body if is_independent(body) else None
+    return [read_body(t) if b is None else b for t, b in zip(texts, bodies)]
+
+
+def is_joinable(text: str) -> bool:
+    # NOTE reference and footnote definitions are global to a document
+    # a title block is only one at the very start of a document
+    # and example lists are numbered over the whole document
+    return "]:" not in text and not text.lstrip().startswith("%") and "(@" not in text
+
+
+def read_joined(texts: Sequence[str]) -> list[list[Block]]:
+    if len(texts) <= 1:
+        return [read_body(t) for t in texts]
+    joined = f"\n\n{batch_separator}\n\n".join(texts)
+    separator = Para([Str(batch_separator)])
+    bodies: list[list[Block]] = [[]]
+    for block in read_body(joined):
+        if block == separator:
+            bodies.append([])
+        else:
+            bodies[-1].append(block)
+    if len(bodies) == len(texts):
+        return bodies
+    # NOTE a document swallowed a separator, eg an unclosed code block
+    # bisect until we isolated the culprit
+    half = len(texts) // 2
+    return read_joined(texts[:half]) + read_joined(texts[half:])
+
+
+def is_independent(body: list[Block]) -> bool:
+    for element in pandoc.iter(body):
+        match element:
+            case Header() | Note():
+                return False
+            case Link(_, _, (url, _)) if url.startswith("#"):
+                return False
+    return True
+
+
+def write_body(body: list[Block], format: str, options: list[str]) -> str:
+    data = pandoc.write(
+        Pandoc(Meta({}), body),  # pyright: ignore[reportAttributeAccessIssue]
+        format=format,
+        options=options,
+    )
+    # TODO note sure in what case we get what
+    assert type(data) is str, type(data)
+    return data
+
+
+def write_bodies(
+    bodies: Sequence[list[Block]], format: str, options: list[str]
+) -> list[str]:
+    """same as write_body for each body, but with as few pandoc processes as possible"""
+    # NOTE empty documents dont render as a paragraph, and headers and notes
+    # are rendered with respect to the whole document, so those are written alone
+    joinable = [
+        i for i, body in enumerate(bodies) if len(body) > 0 and is_independent(body)
+    ]
+    datas: list[None | str] = [None] * len(bodies)
+    for i, data in zip(
+        joinable, write_joined([bodies[i] for i in joinable], format, options)
+    ):
+        datas[i] = data
+    return [
+        write_body(b, format, options) if d is None else d
+        for b, d in zip(bodies, datas)
+    ]
+
+
+def write_joined(
+    bodies: Sequence[list[Block]], format: str, options: list[str]
+) -> list[str]:
+    if len(bodies) <= 1:
+        return [write_body(b, format, options) for b in bodies]
+    separator = Para([Str(batch_separator)])
+    joined = [block for body in bodies for block in [separator, *body]][1:]
+    datas = write_body(joined, format, options).split(f"\n\n{batch_separator}\n\n")
+    if len(datas) == len(bodies):
+        # NOTE every document on its own ends with a newline
+        return [d + "\n" for d in datas[:-1]] + datas[-1:]
+    half = len(bodies) // 2
+    return write_joined(bodies[:half], format, options) + write_joined(
+        bodies[half:], format, options
+    )
+
+
 def split_blocks(blocks: list[Block]) -> tuple[list[Block], list[Block]]:
     [split] = [i for i, e in enumerate(blocks) if e == HorizontalRule()]
     return blocks[:split], blocks[split + 1 :]
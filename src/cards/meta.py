@@ -0,0 +1,93 @@
+"""
+meta.json maps markdown files to the ids of their cards on mochi
+NOTE plain json instead of serde, local commands like move read and write it,
+and they should start fast, serde alone takes several 100 ms to import
+the format is the same as serde writes it
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+
+
+class Direction(Enum):
+    forward = "forward"
+    backward = "backward"
+
+
+@dataclass
+class Meta:
+    forward: None | str
+    backward: None | str
+
+    def set_by_direction(self, direction: Direction, value: None | str):
+        match direction:
+            case Direction.forward:
+                self.forward = value
+            case Direction.backward:
+                self.backward = value
+            case _:
+                assert False
+
+    def get_by_direction(self, direction: Direction) -> None | str:
+        match direction:
+            case Direction.forward:
+                return self.forward
+            case Direction.backward:
+                return self.backward
+            case _:
+                assert False
+
+
+def from_json(data: str) -> dict[str, Meta]:
+    return {p: Meta(m["forward"], m["backward"]) for p, m in json.loads(data).items()}
+
+
+def to_json(meta: dict[str, Meta], indent: None | int = None) -> str:
+    meta_dict = {
+        p: {"forward": m.forward, "backward": m.backward} for p, m in meta.items()
+    }
+    return json.dumps(
+        meta_dict, ensure_ascii=False, separators=(",", ":"), indent=indent
+    )
+
+
+def read_meta(base: Path) -> dict[Path, Meta]:
+    """meta.json with the journal replayed, if there is one from an interrupted sync"""
+    at = base / "meta.json"
+    meta_str = from_json(at.read_text()) if at.exists() else {}
+    journal = base / "meta.journal"
+    if journal.exists():
+        for line in journal.read_text().splitlines(keepends=True):
+            # NOTE a missing newline means we crashed while writing that entry
+            if line.endswith("\n"):
+                meta_str.update(from_json(line))
+    meta = {Path(p): m for p, m in meta_str.items()}
+    return meta
+
+
+def write_meta(base: Path, meta: dict[Path, Meta]):
+    """writes all of meta.json, this also compacts the journal"""
+    # NOTE we sort it so that it's a bit more stable in a potential git diff
+    meta_str = {str(p): m for p, m in sorted(meta.items())}
+    at = base / "meta.json"
+    # NOTE write and rename, so that meta.json is never partially written
+    staged = at.with_name("meta.json.new")
+    staged.write_text(to_json(meta_str, indent=4))
+    staged.replace(at)
+    (base / "meta.journal").unlink(missing_ok=True)
+
+
+def append_meta(base: Path, path: Path, meta: Meta):
+    """
+    journal a change instead of writing all of meta.json for each change
+    every entry is synced to disk, read_meta replays them, write_meta compacts them
+    """
+    with (base / "meta.journal").open("a") as f:
+        f.write(to_json({str(path): meta}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
@@ -1,12 +1,36 @@
+import json
 import os
+from collections.abc import Iterable, Iterator
+from functools import lru_cache
 from pathlib import Path
 from subprocess import CalledProcessError, run
+from urllib.parse import quote
 
-from flask import Flask, current_app, redirect, url_for
+from flask import (
+    Flask,
+    Response,
+    abort,
+    current_app,
+    redirect,
+    send_from_directory,
+    url_for,
+)
+
+from cards.watch import FileIndex, watch
 
 template_path = Path(__file__).parent / "preview-template.html"
 template_path = template_path.absolute()
 
+# NOTE only what cards can show, the watch folder also has credentials and caches
+image_suffixes = {".png", ".jpg", ".jpeg", ".gif", ".svg", ".webp", ".bmp"}
+
+
+def get_katex_path() -> Path:
+    """fails without $h, we dont want to silently render without katex"""
+    # NOTE needs to be local, https://cdn.jsdelivr.net/npm/katex@0.16.4/dist/ will rate-limit
+    return Path(os.environ["h"]) / "result/lib/node_modules/katex/dist"
+
+
 app = Flask(__name__)
 
 
@@ -18,30 +42,34 @@ def index():
 @app.route("/preview")
 def preview():
     # NOTE we read the time _before_ we use it, so worst case it's old, but never new
-    path = get_most_recent_md(current_app.config["watch_folder"])
-    if path is None:
+    most_recent = get_most_recent_md()
+    if most_recent is None:
         return "n/a"
-    stat = path.stat()
-    name = path.relative_to(current_app.config["watch_folder"])
+    path, path_mtime = most_recent
+    folder: Path = current_app.config["watch_folder"]
+    return render(folder, path, path_mtime, template_path.stat().st_mtime)
+
+
+@lru_cache(maxsize=64)
+def render(folder: Path, path: Path, path_mtime: float, template_mtime: float) -> str:
+    """cached by mtimes, images and katex are not embedded, so they dont matter"""
+    name = path.relative_to(folder)
     try:
         result = run(
             [
                 "pandoc",
                 str(path),
-                # needs to be local, because --self-contained copies it everytime
-                # (using https://cdn.jsdelivr.net/npm/katex@0.16.4/dist/ will rate-limit)
-                f"--katex={os.environ['h']}/result/lib/node_modules/katex/dist/",
+                "--katex=/katex/",
                 f"--metadata=pagetitle={name}",
-                # to find images relative to the markdown file
-                f"--resource-path={path.parent}",
-                # embeds images, and even katex
-                # plus output is a full html document
-                # (otherwise it's a html sub-tree)
-                "--self-contained",
+                # NOTE output is a full html document (otherwise it's a html sub-tree)
+                "--standalone",
                 # adapted from 'pandoc -D html'
                 f"--template={template_path}",
                 f"--variable=preview_name:{name}",
-                f"--variable=mtime:{stat.st_mtime}",
+                "--variable=live:true",
+                f"--variable=mtime:{path_mtime}",
+                # to find images relative to the markdown file
+                f"--variable=base:/files/{quote(name.parent.as_posix())}/",
                 "--to=html",
             ],
             check=True,
@@ -53,23 +81,64 @@ def preview():
         return e.stdout + e.stderr
 
 
-@app.route("/mtime")
-def mtime():
-    path = get_most_recent_md(current_app.config["watch_folder"])
-    if path is None:
-        return {"mtime": -1}
-    stat = path.stat()
-    return {"mtime": stat.st_mtime}
+@app.route("/katex/<path:name>")
+def katex(name: str):
+    # NOTE katex does not change while we run
+    return send_from_directory(
+        current_app.config["katex_path"], name, max_age=24 * 60 * 60
+    )
+
+
+@app.route("/files/<path:name>")
+def files(name: str):
+    """images in the deck folders, and nothing else"""
+    folder: Path = current_app.config["watch_folder"]
+    decks: None | list[str] = current_app.config["decks"]
+    if Path(name).suffix.lower() not in image_suffixes:
+        abort(404)
+    if decks is not None:
+        # NOTE served from the deck folder, so that .. cannot leave it
+        deck, _, name = name.partition("/")
+        if deck not in decks:
+            abort(404)
+        folder = folder / deck
+    # NOTE the browser revalidates, and gets a 304 when the file did not change
+    return send_from_directory(folder, name)
+
+
+@app.route("/events")
+def events():
+    """server-sent events with the mtime of the most recent file, when it changes"""
+    index: FileIndex = current_app.config["index"]
+
+    def stream() -> Iterator[str]:
+        last = None
+        while True:
+            most_recent = index.wait_for_change(last, timeout=15)
+            if most_recent == last:
+                # NOTE so that we notice when the browser is gone
+                yield ": keep-alive\n\n"
+                continue
+            last = most_recent
+            mtime = -1 if most_recent is None else most_recent[1]
+            yield f"data: {json.dumps({'mtime': mtime})}\n\n"
+
+    return Response(
+        stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
 
 
-def get_most_recent_md(folder: Path) -> None | Path:
-    candidates = folder.glob("**/*.md")
-    candidates = sorted(candidates, key=lambda c: c.stat().st_mtime)
-    if len(candidates) == 0:
-        return None
-    return candidates[-1]
+def get_most_recent_md() -> None | tuple[Path, float]:
+    index: FileIndex = current_app.config["index"]
+    return index.get_most_recent()
 
 
-def main(watch_folder: Path = Path("./data")):
+def main(watch_folder: Path = Path("./data"), decks: None | Iterable[str] = None):
+    """only the deck folders are watched, or all of watch_folder without decks"""
+    decks = None if decks is None else list(decks)
+    app.config["katex_path"] = get_katex_path()
     app.config["watch_folder"] = watch_folder
-    app.run()
+    app.config["decks"] = decks
+    folders = [watch_folder] if decks is None else [watch_folder / d for d in decks]
+    app.config["index"] = watch(folders)
+    app.run(threaded=True)
@@ -0,0 +1,77 @@
+"""
+finds the image paths of a card directly from its text, without pandoc
+the scanner is conservative, whenever the text has something that pandoc might
+read differently than we do, it does not decide and we ask pandoc instead
+"""
+
+from __future__ import annotations
+
+import re
+from pathlib import Path
+
+# NOTE code, raw html, escapes, entities, math, references, footnotes, tables,
+# definition lists, setext headers, title blocks, fenced divs and example lists
+# change what the lines mean, we leave those to pandoc
+undecidable = re.compile(
+    r"\A\s*%|[`<\\\r\t&$]|:::|\(@|~~~|\]:|\^\[|\[\^|^\s*\+[-=]|^ {0,3}[:~]\s|^\s*=+\s*$",
+    re.MULTILINE,
+)
+# NOTE could be in an indented code block, also in a quote or after any list marker
+indented_image = re.compile(r"^.* {4}.*!\[", re.MULTILINE)
+rule = re.compile(r"^ *([-*_])( *\1){2,} *$")
+image_start = re.compile(r"!\[")
+# NOTE on one line, a line break can end the image, eg in a header
+image = re.compile(
+    r"!\[[^\[\]\n]*\]\( *([^\s()<>|\"{}\[\]^`]+)( +(\"[^\"\n]*\"|'[^'\n]*'))? *\)"
+)
+
+
+def scan(text: str) -> None | list[Path]:
+    """the image paths, None if we cannot tell"""
+    if undecidable.search(text) is not None or indented_image.search(text) is not None:
+        return None
+
+    starts = [m.start() for m in image_start.finditer(text)]
+    matches = list(image.finditer(text))
+    if [m.start() for m in matches] != starts:
+        return None
+
+    lines = text.split("\n")
+    for i, line in enumerate(lines):
+        if rule.match(line) is None:
+            continue
+        before = "" if i == 0 else lines[i - 1]
+        after = "" if i == len(lines) - 1 else lines[i + 1]
+        # NOTE at the start it could be yaml, after text a setext header or a table
+        # and before text a table or yaml again, and yaml values are not in the body
+        if i == 0 or before.strip() != "" or after.strip() != "" or line[0] == " ":
+            return None
+
+    return [Path(m.group(1)) for m in matches]
+
+
+def get_image_paths(text: str) -> list[Path]:
+    """same as Markdown.get_image_paths, but mostly without pandoc"""
+    image_paths = scan(text)
+    if image_paths is not None:
+        return image_paths
+    # NOTE imported here, so that we dont pay for it when we dont need it
+    from cards.markdown import Markdown
+
+    return Markdown.from_str(text).get_image_paths()
+
+
+def check(texts: dict[Path, str]) -> tuple[int, list[Path]]:
+    """how many texts the scanner decided, and where it disagrees with pandoc"""
+    from cards.markdown import Markdown
+
+    decided = 0
+    wrong: list[Path] = []
+    for path, text in texts.items():
+        image_paths = scan(text)
+        if image_paths is None:
+            continue
+        decided += 1
+        if image_paths != Markdown.from_str(text).get_image_paths():
+            wrong.append(path)
+    return decided, wrong
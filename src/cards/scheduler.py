@@ -0,0 +1,114 @@
+"""
+pace requests to the mochi api
+so that bulk operations go as fast as the server allows, but not faster
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+
+@dataclass
+class Scheduler:
+    """
+    a token bucket limits the request rate, and there is a limit of requests in flight
+    both adapt to the server with additive increase and multiplicative decrease (AIMD)
+    throttling (429) and failures decrease, successes increase
+    but only while latency is not much worse than the best we have seen
+    """
+
+    rate: float = 10  # requests per second
+    min_rate: float = 0.5
+    max_rate: float = 100
+    burst: float = 10
+    concurrency: float = 4  # float so that it can grow additively
+    max_concurrency: int = 16
+    # NOTE we stop increasing when latency is that much worse than the best seen
+    latency_tolerance: float = 2
+
+    # NOTE for logging
+    requests: int = 0
+    throttled: int = 0
+
+    tokens: float = 0
+    in_flight: int = 0
+    refilled: float = field(default_factory=time.monotonic)
+    decreased: float = 0
+    latency: None | float = None  # moving average
+    best_latency: None | float = None
+    condition: threading.Condition = field(default_factory=threading.Condition)
+
+    def __post_init__(self):
+        self.tokens = self.burst
+
+    @contextmanager
+    def slot(self) -> Iterator[None]:
+        """wait for a token and a free slot, then run one request"""
+        with self.condition:
+            while True:
+                self.refill()
+                if self.tokens >= 1 and self.in_flight < int(self.concurrency):
+                    break
+                # NOTE wakes up early when a slot frees up or rates change
+                self.condition.wait(max(0.01, (1 - self.tokens) / self.rate))
+            self.tokens -= 1
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    def observe(self, status: None | int, latency: float):
+        """status is None when there was no response at all"""
+        with self.condition:
+            self.requests += 1
+            if status == 429:
+                self.throttled += 1
+            if status is None or status == 429 or status >= 500:
+                self.decrease(latency)
+            else:
+                self.increase(latency)
+            self.condition.notify_all()
+
+    def decrease(self, latency: float):
+        now = time.monotonic()
+        # NOTE requests in flight will all see the same throttling
+        # decrease only once per round trip, not for each of them
+        if now - self.decreased < max(latency, self.latency or 0):
+            return
+        self.decreased = now
+        self.rate = max(self.min_rate, self.rate * 0.7)
+        self.concurrency = max(1, self.concurrency * 0.7)
+
+    def increase(self, latency: float):
+        self.latency = (
+            latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+        )
+        self.best_latency = min(self.best_latency or latency, latency)
+        if self.latency > self.latency_tolerance * self.best_latency:
+            return
+        # NOTE about +1 per round trip for concurrency, and +1 per second for the rate
+        # but until the first decrease, we double the rate every second (slow start)
+        self.concurrency = min(
+            self.max_concurrency, self.concurrency + 1 / self.concurrency
+        )
+        slow_start = self.decreased == 0
+        self.rate = min(self.max_rate, self.rate + (1 if slow_start else 1 / self.rate))
+
+    def summary(self) -> str:
+        return (
+            f"{self.requests} requests, {self.throttled} throttled, "
+            f"now at {self.rate:.1f} requests/s "
+            f"and {int(self.concurrency)} concurrent requests"
+        )
@@ -1,47 +1,140 @@
 from __future__ import annotations
 
-from collections.abc import Iterator, Mapping
+import json
+import threading
+from collections.abc import Callable, Collection, Iterator, Mapping
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from dataclasses import dataclass
 from pathlib import Path
 
-from requests.auth import HTTPBasicAuth
+from tqdm import tqdm
 
 from cards import api
-from cards.data import Card, Meta
+from cards.data import Card
+from cards.meta import Meta
+
+
+def list_remote(
+    client: api.MochiClient,
+    deck_ids: Collection[str],
+    concurrency: int = 1,
+    progress: bool = True,
+    cancelled: None | threading.Event = None,
+) -> dict[str, api.Card]:
+    """
+    all cards of the given decks, decks are listed concurrently
+    once cancelled, listing stops after the pages in flight, with what it has so far
+    """
+    cancelled = threading.Event() if cancelled is None else cancelled
+    remote: dict[str, api.Card] = dict()
+    with (
+        ThreadPoolExecutor(concurrency) as pool,
+        tqdm(desc="list cards", disable=not progress) as bar,
+    ):
+
+        def list_deck(deck_id: str) -> list[api.Card]:
+            cards = []
+            if cancelled.is_set():
+                return cards
+            for card in api.list_cards(client, deck_id):
+                if cancelled.is_set():
+                    break
+                cards.append(card)
+                bar.update()
+            return cards
+
+        for cards in pool.map(list_deck, deck_ids):
+            remote.update((card.id, card) for card in cards)
+    return remote
+
+
+def read_snapshot(base: Path) -> dict[str, dict[str, api.Card]]:
+    """deck id -> card id -> card, as of the end of the last sync"""
+    at = base / ".cache" / "remote.json"
+    if not at.exists():
+        return {}
+    return {
+        deck_id: {doc["id"]: api.Card(**doc) for doc in docs}
+        for deck_id, docs in json.loads(at.read_text()).items()
+    }
+
+
+def write_snapshot(base: Path, deck_ids: Collection[str], state: dict[str, api.Card]):
+    """all decks in deck_ids are snapshotted, also empty ones"""
+    snapshot: dict[str, list[dict]] = {deck_id: [] for deck_id in deck_ids}
+    for card in state.values():
+        snapshot[card.deck_id].append(card.model_dump(by_alias=True))
+    at = base / ".cache" / "remote.json"
+    at.parent.mkdir(parents=True, exist_ok=True)
+    at.write_text(json.dumps(snapshot))
 
 
 def states_from_apply_diff(
-    auth: HTTPBasicAuth,
+    client: api.MochiClient,
     decks: Mapping[str, str],  # deck name -> mochi deck id
     state: dict[str, api.Card],
     diff: MochiDiff,
     meta: dict[Path, Meta],
-) -> Iterator[tuple[dict[str, api.Card], dict[Path, Meta]]]:
-    for id, card in diff.changed.items():
-        u = api.update_card(
-            auth,
-            api.Card(
-                id=id,
-                content=card.content,
-                deck_id=decks[card.deck_name],
-            ),
-            attachments=card.attachments,
-        )
+    concurrency: int = 1,
+) -> Iterator[tuple[dict[str, api.Card], dict[Path, Meta], None | Path]]:
+    """
+    the api calls run concurrently, but state and meta are only updated here
+    in the calling thread, in place, and yielded after every completed operation
+    together with the path whose meta changed, if any
+    on errors or interruptions, operations in flight are waited for and recorded
+    so that the caller can still write meta without losing created card ids
+    """
+
+    def changed(u: api.Card) -> None:
         state[u.id] = u
-        yield state, meta
 
-    for card in diff.removed:
-        api.delete_card(auth, card.id)
-        state.pop(card.id)
-        yield state, meta
+    def removed(card: api.Card) -> Callable[[None], None]:
+        def f(_):
+            state.pop(card.id)
 
-    for card in diff.new:
-        u = api.create_card(auth, decks[card.deck_name], card.content, card.attachments)
-        meta.setdefault(card.path, Meta(None, None)).set_by_direction(
-            card.direction, u.id
-        )
-        state[u.id] = u
-        yield state, meta
+        return f
+
+    def new(card: Card) -> Callable[[api.Card], Path]:
+        def f(u: api.Card) -> Path:
+            meta.setdefault(card.path, Meta(None, None)).set_by_direction(
+                card.direction, u.id
+            )
+            state[u.id] = u
+            return card.path
+
+        return f
+
+    pool = ThreadPoolExecutor(concurrency)
+    pending: dict[Future, Callable[..., None | Path]] = dict()
+    try:
+        for id, card in diff.changed.items():
+            u = api.Card(id=id, content=card.content, deck_id=decks[card.deck_name])
+            # NOTE the content has the image hashes, so unchanged images are already there
+            attachments = card.attachments_changed_from(state[id].content)
+            pending[pool.submit(api.update_card, client, u, attachments)] = changed
+
+        for card in diff.removed:
+            pending[pool.submit(api.delete_card, client, card.id)] = removed(card)
+
+        for card in diff.new:
+            future = pool.submit(
+                api.create_card,
+                client,
+                decks[card.deck_name],
+                card.content,
+                card.attachments,
+            )
+            pending[future] = new(card)
+
+        for future in as_completed(list(pending)):
+            path = pending.pop(future)(future.result())
+            yield state, meta, path
+
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+        for future, apply in pending.items():
+            if not future.cancelled() and future.exception() is None:
+                apply(future.result())
 
 
 @dataclass
@@ -1,60 +1,188 @@
+import threading
 from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import click
 from tqdm import tqdm
 
-from cards.api import auth_from_token, list_cards
-from cards.data import (
-    MetaDiff,
-    get_cards,
-    get_synced_meta,
-    read_markdowns,
-    read_meta,
-    write_meta,
+from cards.api import Card, MochiClient, default_base_url
+from cards.cache import Cache
+from cards.config import ImageEncoding
+from cards.data import MetaDiff, get_cards, get_synced_meta, read_markdowns
+from cards.fingerprints import (
+    get_fingerprints,
+    get_inputs,
+    get_settings,
+    get_unchanged,
+    hash_of,
+    read_fingerprints,
+    write_fingerprints,
 )
-from cards.state import MochiDiff, states_from_apply_diff
+from cards.meta import append_meta, read_meta, write_meta
+from cards.state import (
+    MochiDiff,
+    list_remote,
+    read_snapshot,
+    states_from_apply_diff,
+    write_snapshot,
+)
+from cards.trace import Tracer
 
 
-def sync(token: str, base: Path, decks: Mapping[str, str]):
-    auth = auth_from_token(token)
+def sync(
+    token: str,
+    base: Path,
+    decks: Mapping[str, str],
+    use_cache: bool = True,
+    jobs: int = 1,
+    concurrency: int = 1,
+    full: bool = False,
+    fast: bool = False,
+    confirm: bool = True,
+    base_url: str = default_base_url,
+    tracer: None | Tracer = None,
+    image_encoding: ImageEncoding = ImageEncoding(),
+):
+    tracer = Tracer() if tracer is None else tracer
+    client = MochiClient.from_token(
+        token, pool_size=concurrency, base_url=base_url, tracer=tracer
+    )
 
-    markdowns = read_markdowns(base, decks.keys())
-    meta = read_meta(base)
+    # NOTE in fast mode we trust the snapshot from the last sync instead of listing
+    # it has what we listed back then and what we wrote since, but not changes from elsewhere
+    snapshot = read_snapshot(base) if fast else {}
 
-    synced_meta = get_synced_meta(markdowns, meta)
-    meta_diff = MetaDiff.from_states(meta, synced_meta)
-    meta_diff.print_summary()
-    if meta_diff.count() > 0:
-        click.confirm("Continue?", abort=True)
-        write_meta(base, synced_meta)
-        meta = synced_meta
+    # NOTE listing is network bound, it runs in the background while we make cards
+    cancelled = threading.Event()
 
-    existing_cards, new_cards = get_cards(base, markdowns, meta)
+    def list_in_background() -> dict[str, Card]:
+        with tracer.phase("list"):
+            return list_remote(
+                client,
+                [d for d in decks.values() if d not in snapshot],
+                concurrency,
+                progress=False,
+                cancelled=cancelled,
+            )
 
-    remote = {
-        c.id: c
-        for c in tqdm(
-            list_cards(auth),
-            total=len(existing_cards),
-            desc=f"list cards",
-        )
-    }
+    background = ThreadPoolExecutor(1)
+    listing = background.submit(list_in_background)
+    background.shutdown(wait=False)
+
+    # NOTE when we leave early, eg on an abort or an error, the listing stops
+    # otherwise we would wait for it before we exit, after it is done this changes nothing
+    try:
+        with tracer.phase("read markdowns"):
+            markdown_cache = Cache.from_base(base, "markdown", enabled=use_cache)
+            markdowns = read_markdowns(base, decks.keys(), markdown_cache, jobs)
+            markdown_cache.prune()
+
+        with tracer.phase("sync meta"):
+            meta = read_meta(base)
+            # NOTE compacts the journal of an interrupted sync, before we append to it again
+            if (base / "meta.journal").exists():
+                write_meta(base, meta)
+            synced_meta = get_synced_meta(markdowns, meta)
+            meta_diff = MetaDiff.from_states(meta, synced_meta)
+        meta_diff.print_summary()
+        if meta_diff.count() > 0:
+            if confirm:
+                click.confirm("Continue?", abort=True)
+            write_meta(base, synced_meta)
+            meta = synced_meta
+
+        with tracer.phase("make cards"):
+            settings = get_settings(image_encoding)
+            inputs = get_inputs(base, markdowns)
+            fingerprints = {} if full else read_fingerprints(base)
+            unchanged = get_unchanged(meta, inputs, fingerprints, settings)
+            unchanged_paths = {path for path, _ in unchanged.values()}
+
+            image_cache = Cache.from_base(base, "images", enabled=use_cache)
+            existing_cards, new_cards = get_cards(
+                base,
+                {p: m for p, m in markdowns.items() if p not in unchanged_paths},
+                meta,
+                image_cache,
+                jobs,
+                image_encoding,
+            )
+
+        with tracer.phase("wait for list"):
+            remote = {
+                id: card
+                for deck_id in decks.values()
+                if deck_id in snapshot
+                for id, card in snapshot[deck_id].items()
+            }
+            remote |= listing.result()
+            write_snapshot(base, decks.values(), remote)
+    finally:
+        cancelled.set()
     for card in remote.values():
         assert not card.archived, card.id
         assert card.trashed is None, card.id
         assert not card.review_reverse, card.id
         assert card.template_id is None, card.id
 
-    diff = MochiDiff.from_states(remote, existing_cards, new_cards, decks)
+    # NOTE unchanged cards are only really unchanged if the remote is still what we made
+    unverified_paths = {
+        path
+        for id, (path, content_hash) in unchanged.items()
+        if id not in remote
+        or hash_of(remote[id].content) != content_hash
+        or remote[id].deck_id != decks[path.parts[0]]
+    }
+    if len(unverified_paths) > 0:
+        with tracer.phase("make cards"):
+            more_existing_cards, more_new_cards = get_cards(
+                base,
+                {p: markdowns[p] for p in unverified_paths},
+                meta,
+                image_cache,
+                jobs,
+                image_encoding,
+            )
+            assert set(existing_cards).isdisjoint(more_existing_cards)
+            existing_cards |= more_existing_cards
+            new_cards += more_new_cards
+    image_cache.prune()
+    unchanged = {
+        id: (path, content_hash)
+        for id, (path, content_hash) in unchanged.items()
+        if path not in unverified_paths
+    }
+
+    with tracer.phase("diff"):
+        diff = MochiDiff.from_states(
+            {id: card for id, card in remote.items() if id not in unchanged},
+            existing_cards,
+            new_cards,
+            decks,
+        )
     diff.print_summary()
 
     if diff.count() > 0:
-        click.confirm("Continue?", abort=True)
-        for state, meta in tqdm(
-            states_from_apply_diff(auth, decks, remote, diff, meta),
-            total=diff.count(),
-            desc="sync",
-        ):
-            assert len(state) > 0
+        if confirm:
+            click.confirm("Continue?", abort=True)
+        applied = states_from_apply_diff(client, decks, remote, diff, meta, concurrency)
+        try:
+            with tracer.phase("apply"):
+                for state, meta, path in tqdm(applied, total=diff.count(), desc="sync"):
+                    assert len(state) > 0
+                    if path is not None:
+                        append_meta(base, path, meta[path])
+        finally:
+            # NOTE closing waits for operations in flight and records them in meta
+            applied.close()
             write_meta(base, meta)
+            write_snapshot(base, decks.values(), remote)
+            print(client.scheduler.summary())
+
+    # NOTE only after a successful sync, the remote has now what we made
+    write_fingerprints(
+        base,
+        {path: fingerprints[path] for path, _ in unchanged.values()}
+        | get_fingerprints(inputs, [*existing_cards.values(), *new_cards], settings),
+    )
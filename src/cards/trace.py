@@ -0,0 +1,149 @@
+"""
+where does the time go
+phases and http requests are recorded as chrome trace events
+open the written file with chrome://tracing or https://ui.perfetto.dev
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import re
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+def endpoint_of(at: str) -> str:
+    """cards/abc/attachments/i0.png -> cards/{id}/attachments/{file}"""
+    at = re.sub(r"^cards/[^/]+", "cards/{id}", at)
+    return re.sub(r"/attachments/[^/]+$", "/attachments/{file}", at)
+
+
+@dataclass
+class Phase:
+    name: str
+    wall: float
+    cpu: float
+
+
+@dataclass
+class Request:
+    method: str
+    endpoint: str
+    status: None | int  # None when there was no response
+    bytes_sent: int
+    bytes_received: int
+    latency: float
+
+
+@dataclass
+class Tracer:
+    """
+    cpu time is for the whole process, including other threads
+    but not including other processes, like pandoc or a process pool
+    """
+
+    start: float = field(default_factory=time.perf_counter)
+    events: list[dict] = field(default_factory=list)
+    phases: list[Phase] = field(default_factory=list)
+    requests: list[Request] = field(default_factory=list)
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def add_event(
+        self, name: str, category: str, start: float, duration: float, args: dict
+    ):
+        with self.lock:
+            self.events.append(
+                {
+                    "name": name,
+                    "cat": category,
+                    "ph": "X",
+                    "ts": (start - self.start) * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            self.add_event(name, "phase", start, wall, {"cpu": cpu})
+            with self.lock:
+                self.phases.append(Phase(name, wall, cpu))
+
+    def request(self, request: Request, start: float):
+        self.add_event(
+            f"{request.method} {request.endpoint}",
+            "http",
+            start,
+            request.latency,
+            {
+                "status": request.status,
+                "bytes sent": request.bytes_sent,
+                "bytes received": request.bytes_received,
+            },
+        )
+        with self.lock:
+            self.requests.append(request)
+
+    def write(self, path: Path):
+        with self.lock:
+            path.write_text(json.dumps({"traceEvents": self.events}))
+
+    def print_summary(self):
+        rows = [["phase", "count", "wall s", "cpu s", "", ""]]
+        by_phase: dict[str, list[Phase]] = dict()
+        for phase in self.phases:
+            by_phase.setdefault(phase.name, []).append(phase)
+        for name, phases in by_phase.items():
+            rows.append(
+                [
+                    name,
+                    str(len(phases)),
+                    f"{sum(p.wall for p in phases):.2f}",
+                    f"{sum(p.cpu for p in phases):.2f}",
+                    "",
+                    "",
+                ]
+            )
+
+        rows.append(
+            ["request", "count", "latency s", "max s", "kB sent", "kB received"]
+        )
+        by_endpoint: dict[str, list[Request]] = dict()
+        for request in self.requests:
+            by_endpoint.setdefault(f"{request.method} {request.endpoint}", []).append(
+                request
+            )
+        for name, requests in sorted(by_endpoint.items()):
+            rows.append(
+                [
+                    name,
+                    str(len(requests)),
+                    f"{sum(r.latency for r in requests):.2f}",
+                    f"{max(r.latency for r in requests):.2f}",
+                    f"{sum(r.bytes_sent for r in requests) / 1000:.0f}",
+                    f"{sum(r.bytes_received for r in requests) / 1000:.0f}",
+                ]
+            )
+
+        widths = [max(len(c) for c in column) for column in zip(*rows)]
+        for row in rows:
+            print(
+                "  ".join(
+                    [row[0].ljust(widths[0])]
+                    + [c.rjust(w) for c, w in zip(row[1:], widths[1:])]
+                )
+            )
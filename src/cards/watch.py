@@ -0,0 +1,290 @@
+"""
+an in-memory index of the markdown files in some folders, kept up to date
+by inotify on linux, otherwise by an incremental scanner that only lists
+folders whose mtime changed
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import struct
+import sys
+import threading
+import time
+from collections.abc import Iterable
+from contextlib import suppress
+from dataclasses import dataclass, field
+from errno import ENOMEM, ENOSPC
+from pathlib import Path
+
+
+@dataclass
+class FileIndex:
+    """path -> mtime, and the most recent path, which is O(1) to get"""
+
+    mtimes: dict[Path, float] = field(default_factory=dict)
+    most_recent: None | Path = None
+    # NOTE notified when the most recent path or its mtime changes
+    lock: threading.Condition = field(default_factory=threading.Condition)
+
+    def get_most_recent(self) -> None | tuple[Path, float]:
+        with self.lock:
+            if self.most_recent is None:
+                return None
+            return self.most_recent, self.mtimes[self.most_recent]
+
+    def wait_for_change(
+        self, last: None | tuple[Path, float], timeout: float
+    ) -> None | tuple[Path, float]:
+        """returns as soon as the most recent differs from last, or after timeout"""
+        with self.lock:
+            self.lock.wait_for(lambda: self.get_most_recent() != last, timeout)
+            return self.get_most_recent()
+
+    def update(self, path: Path):
+        """stats the path, a missing or non-markdown file is removed"""
+        if path.suffix != ".md":
+            return
+        try:
+            mtime = path.stat().st_mtime
+        except OSError:
+            self.remove([path])
+            return
+        with self.lock:
+            self.mtimes[path] = mtime
+            if self.most_recent is None or mtime >= self.mtimes[self.most_recent]:
+                self.most_recent = path
+                self.lock.notify_all()
+
+    def remove(self, paths: Iterable[Path]):
+        with self.lock:
+            for path in paths:
+                self.mtimes.pop(path, None)
+            if self.most_recent not in self.mtimes:
+                # NOTE O(n), but only when the most recent file is gone
+                self.most_recent = max(
+                    self.mtimes, key=self.mtimes.__getitem__, default=None
+                )
+                self.lock.notify_all()
+
+    def remove_under(self, folder: Path):
+        with self.lock:
+            paths = [p for p in self.mtimes if p.is_relative_to(folder)]
+        self.remove(paths)
+
+
+# NOTE from <sys/inotify.h>
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+event_header = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def load_libc() -> None | ctypes.CDLL:
+    if os.uname().sysname != "Linux":
+        return None
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    return libc
+
+
+@dataclass
+class Inotify:
+    """one watch per folder, including sub-folders, as inotify is not recursive"""
+
+    index: FileIndex
+    roots: list[Path]
+    libc: ctypes.CDLL
+    fd: int
+    folders: dict[int, Path] = field(default_factory=dict)
+
+    mask = (
+        IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    )
+
+    @classmethod
+    def start(cls, index: FileIndex, roots: Iterable[Path]) -> None | Inotify:
+        libc = load_libc()
+        if libc is None:
+            return None
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+        if fd < 0:
+            return None
+        inotify = cls(index, list(roots), libc, fd)
+        try:
+            inotify.add_roots()
+        except OSError:
+            # NOTE most likely out of watches, see fs.inotify.max_user_watches
+            os.close(fd)
+            index.remove_under(Path("/"))
+            return None
+        threading.Thread(target=inotify.run, daemon=True).start()
+        return inotify
+
+    def add_roots(self):
+        for root in self.roots:
+            self.add(root)
+
+    def add(self, folder: Path):
+        """
+        watches the folder, then indexes what is already in it
+        folders that are already gone again are skipped, like temporary ones of editors
+        """
+        if not folder.is_dir():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), self.mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            # NOTE out of watches or memory, we cannot watch everything anymore
+            if errno in (ENOSPC, ENOMEM):
+                raise OSError(errno, os.strerror(errno), str(folder))
+            return
+        self.folders[wd] = folder
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return
+        for entry in entries:
+            path = Path(entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                self.add(path)
+            else:
+                self.index.update(path)
+
+    def run(self):
+        try:
+            while True:
+                data = os.read(self.fd, 64 * 1024)
+                offset = 0
+                while offset < len(data):
+                    wd, mask, _, length = event_header.unpack_from(data, offset)
+                    offset += event_header.size
+                    name = data[offset : offset + length].rstrip(b"\0")
+                    offset += length
+                    self.handle(wd, mask, os.fsdecode(name))
+        except OSError as e:
+            # NOTE eg out of watches, or the fd broke, the scanner takes over
+            print(f"inotify failed, scanning instead: {e}", file=sys.stderr)
+            with suppress(OSError):
+                os.close(self.fd)
+            self.index.remove_under(Path("/"))
+            Scanner.start(self.index, self.roots)
+
+    def handle(self, wd: int, mask: int, name: str):
+        if mask & IN_Q_OVERFLOW:
+            # NOTE we missed events, so we start over
+            for other in list(self.folders):
+                self.libc.inotify_rm_watch(self.fd, other)
+            self.folders.clear()
+            self.index.remove_under(Path("/"))
+            self.add_roots()
+            return
+        if mask & IN_IGNORED:
+            self.folders.pop(wd, None)
+            return
+        folder = self.folders.get(wd)
+        if folder is None:
+            return
+        path = folder / name
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add(path)
+            elif mask & (IN_MOVED_FROM | IN_DELETE):
+                for other, f in list(self.folders.items()):
+                    if f.is_relative_to(path):
+                        self.libc.inotify_rm_watch(self.fd, other)
+                        self.folders.pop(other)
+                self.index.remove_under(path)
+            return
+        self.index.update(path)
+
+
+@dataclass
+class Scanner:
+    """
+    the fallback, it stats every known file and folder every interval
+    but lists only folders that changed, new and removed files change the folder mtime
+    """
+
+    index: FileIndex
+    roots: list[Path]
+    interval: float = 0.5  # seconds
+    folders: dict[Path, float] = field(default_factory=dict)
+    files: dict[Path, set[Path]] = field(default_factory=dict)
+
+    @classmethod
+    def start(cls, index: FileIndex, roots: Iterable[Path]) -> Scanner:
+        scanner = cls(index, list(roots))
+        scanner.scan()
+        threading.Thread(target=scanner.run, daemon=True).start()
+        return scanner
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.scan()
+
+    def scan(self):
+        for root in self.roots:
+            if root not in self.folders:
+                self.list(root)
+        for folder, mtime in list(self.folders.items()):
+            try:
+                changed = folder.stat().st_mtime != mtime
+            except FileNotFoundError:
+                self.forget(folder)
+                continue
+            if changed:
+                self.list(folder)
+        for files in list(self.files.values()):
+            for path in files:
+                self.index.update(path)
+
+    def list(self, folder: Path):
+        try:
+            mtime = folder.stat().st_mtime
+            entries = list(os.scandir(folder))
+        except (FileNotFoundError, NotADirectoryError):
+            self.forget(folder)
+            return
+        self.folders[folder] = mtime
+        files = set()
+        for entry in entries:
+            path = Path(entry.path)
+            if entry.is_dir(follow_symlinks=False):
+                if path not in self.folders:
+                    self.list(path)
+            elif path.suffix == ".md":
+                files.add(path)
+        removed = self.files.get(folder, set()) - files
+        self.index.remove(removed)
+        for path in files - self.files.get(folder, set()):
+            self.index.update(path)
+        self.files[folder] = files
+
+    def forget(self, folder: Path):
+        for f in [f for f in self.folders if f.is_relative_to(folder)]:
+            self.folders.pop(f)
+            self.files.pop(f, None)
+        self.index.remove_under(folder)
+
+
+def watch(roots: Iterable[Path]) -> FileIndex:
+    """returns an index that is kept up to date in the background"""
+    roots = list(roots)
+    index = FileIndex()
+    if Inotify.start(index, roots) is None:
+        Scanner.start(index, roots)
+    return index
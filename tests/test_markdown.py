@@ -0,0 +1,19 @@
+from cards.markdown import read_bodies, read_body
+
+# NOTE texts that pandoc reads differently when they are not alone in a document
+texts = [
+    "% title\n\nq\n\n---\n\na",
+    "(@) one\n(@) two\n\n---\n\na",
+    "q [a][r]\n\n[r]: x.png\n\n---\n\na",
+    "q[^1]\n\n[^1]: note\n\n---\n\na",
+    "# h\n\nq\n\n---\n\na",
+    "```\nunclosed\n\n---\n\na",
+    "q ![](a.png)\n\n---\n\na",
+]
+
+
+def test_batched_reads_are_single_reads():
+    for i in range(len(texts)):
+        # NOTE every text once not first in its batch
+        batch = texts[i:] + texts[:i]
+        assert read_bodies(batch) == [read_body(t) for t in batch]
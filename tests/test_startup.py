@@ -0,0 +1,38 @@
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from cards.meta import Meta, write_meta
+
+# NOTE the editor runs move all the time, these take long to import
+heavy = ["typer", "rich", "pandoc", "pypandoc", "PIL"]
+
+
+def test_move_is_light(tmp_path: Path):
+    (tmp_path / "config.toml").write_text('decks = { a = "id-a", b = "id-b" }\n')
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    (tmp_path / "a" / "card.md").write_text("q\n\n---\n\na\n")
+    write_meta(tmp_path, {Path("a/card.md"): Meta("card-id", None)})
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-m", "cards"]
+        + [str(tmp_path), "move", str(tmp_path / "a" / "card.md"), "b"],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    seconds = time.perf_counter() - start
+
+    assert (tmp_path / "b" / "card.md").exists()
+    # NOTE lines are "import time: self [us] | cumulative | imported package"
+    imported = {
+        line.rsplit("|", 1)[1].strip().split(".")[0]
+        for line in result.stderr.splitlines()
+        if line.startswith("import time:")
+    }
+    assert imported.isdisjoint(heavy), imported & set(heavy)
+    # NOTE generous, move takes about 0.1s here and the full cli more than 0.5s
+    assert seconds < 2, seconds